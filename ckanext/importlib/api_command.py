@@ -1,4 +1,7 @@
+import urllib2
+
 from command import Command
+from connection_pool import install_pooled_transport
 
 from ckanclient import CkanClient
 
@@ -23,6 +26,9 @@ class ApiCommand(Command):
         self.parser.add_option("-p", "--password",
                           dest="password",
                           help="Password for HTTP Basic Authentication")
+        self.parser.add_option("--pool-size",
+                          dest="pool_size", type="int", default=None,
+                          help="Reuse HTTP connections to the API, keeping up to this many open")
         
     def command(self):
         super(ApiCommand, self).command()
@@ -36,13 +42,28 @@ class ApiCommand(Command):
                 self.parser.error('--host must start with "http://"')
             if not '/api' in self.options.api_url:
                 self.parser.error('--host must have "/api" towards the end')
-        user_agent = self.user_agent if hasattr(self, 'user_agent') else 'ckanext-importlib/ApiCommand'
-
-        self.client = CkanClient(base_location=self.options.api_url,
-                                 api_key=self.options.api_key,
-                                 http_user=self.options.username,
-                                 http_pass=self.options.password,
-                                 is_verbose=True,
-                                 user_agent=user_agent)
+        self.client = self.create_client()
+        if self.options.pool_size:
+            # (after creating the client, which may install its own opener)
+            self.connection_pool = install_pooled_transport(
+                pool_size=self.options.pool_size,
+                base_location=self.options.api_url,
+                http_user=self.options.username,
+                http_pass=self.options.password)
 
         # now do command
+
+    def create_client(self):
+        '''Returns a new CkanClient for the API. Can be used as the
+        ckanclient_factory for a concurrent load.'''
+        user_agent = self.user_agent if hasattr(self, 'user_agent') else 'ckanext-importlib/ApiCommand'
+        client = CkanClient(base_location=self.options.api_url,
+                            api_key=self.options.api_key,
+                            http_user=self.options.username,
+                            http_pass=self.options.password,
+                            is_verbose=True,
+                            user_agent=user_agent)
+        if getattr(self, 'connection_pool', None):
+            # CkanClient replaces the opener if given HTTP auth details
+            urllib2.install_opener(self.connection_pool.opener)
+        return client
@@ -0,0 +1,69 @@
+'''
+Loaders which keep many CKAN requests in flight from one process without
+a thread for each, using gevent (an optional dependency).
+
+This library runs on Python 2, which has no asyncio. Instead these rely on
+gevent's monkey-patching, which makes the standard library's sockets
+(used by ckanclient, via urllib2), threads, locks and queues cooperative.
+The concurrent load_packages of PackageLoader then runs its workers as
+greenlets, so the find/ensure-name/write/merge logic is exactly that of
+the normal loaders.
+
+The process must be patched before anything else is imported:
+
+    from gevent import monkey; monkey.patch_all()
+
+    loader = AsyncReplaceByExtraFieldLoader(client, 'ref', concurrency=200)
+    loader.load_packages(pkg_dicts, ckanclient_factory=make_client)
+
+pkg_dicts can be any iterable, including a generator that itself waits on
+I/O - it is read lazily, a few items ahead of the workers.
+'''
+from loader import PackageLoader, ReplaceByNameLoader, \
+     ReplaceByExtraFieldLoader, ResourceSeriesLoader, LoaderError
+
+DEFAULT_CONCURRENCY = 100
+
+class AsyncPackageLoader(PackageLoader):
+    '''Mixin for a PackageLoader (subclass) that loads packages in greenlets.
+    @param concurrency - the maximum number of packages being loaded at once
+    '''
+    def __init__(self, *args, **kwargs):
+        self.concurrency = kwargs.pop('concurrency', DEFAULT_CONCURRENCY)
+        super(AsyncPackageLoader, self).__init__(*args, **kwargs)
+
+    def load_packages(self, pkg_dicts, workers=None, ckanclient_factory=None,
+                      journal=None):
+        '''Loads multiple packages, up to self.concurrency (or workers) at
+        once. Each greenlet uses its own ckanclient from the
+        ckanclient_factory.
+
+        @return results and resulting package names/ids.
+        '''
+        self._check_gevent_patched()
+        return super(AsyncPackageLoader, self).load_packages(
+            pkg_dicts, workers=workers or self.concurrency,
+            ckanclient_factory=ckanclient_factory, journal=journal)
+
+    def _check_gevent_patched(self):
+        try:
+            from gevent import monkey
+        except ImportError:
+            raise LoaderError('%s requires gevent to be installed' % \
+                              self.__class__.__name__)
+        for module in ('socket', 'thread'):
+            if not monkey.is_module_patched(module):
+                raise LoaderError('%s requires gevent monkey-patching - call '
+                                  'gevent.monkey.patch_all() at start-up' % \
+                                  self.__class__.__name__)
+
+
+class AsyncReplaceByNameLoader(AsyncPackageLoader, ReplaceByNameLoader):
+    pass
+
+class AsyncReplaceByExtraFieldLoader(AsyncPackageLoader,
+                                     ReplaceByExtraFieldLoader):
+    pass
+
+class AsyncResourceSeriesLoader(AsyncPackageLoader, ResourceSeriesLoader):
+    pass
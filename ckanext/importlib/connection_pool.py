@@ -0,0 +1,184 @@
+'''
+Persistent (keep-alive) HTTP connections for ckanclient.
+
+ckanclient opens each API request with urllib2, which makes a new
+connection (and for HTTPS, a new TLS handshake) every time. These urllib2
+handlers instead reuse HTTP/1.1 connections, kept in a pool per host. The
+pool is thread-safe, so one can be shared by the ckanclients of
+concurrent loader workers.
+
+ckanclient uses urllib2's installed opener, so to use the pool with every
+ckanclient in the process:
+
+    install_pooled_transport(pool_size=8)
+'''
+import httplib
+import socket
+import threading
+import urllib
+import urllib2
+from StringIO import StringIO
+
+log = __import__("logging").getLogger(__name__)
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD') # requests which are safe to repeat
+
+class RequestError(Exception):
+    '''A request on a connection failed.
+    @param error - the httplib or socket exception
+    @param before_sent - whether it failed while sending the request, so
+                         the server cannot have received all of it, nor
+                         acted on it
+    '''
+    def __init__(self, error, before_sent):
+        Exception.__init__(self, error)
+        self.error = error
+        self.before_sent = before_sent
+
+class ConnectionPool(object):
+    '''Keeps open HTTP/HTTPS connections for reuse.
+    @param pool_size - maximum number of idle connections kept per host
+    @param timeout - socket timeout in seconds (None for the default)
+    '''
+    def __init__(self, pool_size=4, timeout=None):
+        assert pool_size > 0, pool_size
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.num_connections_made = 0
+        self.opener = None # set by install_pooled_transport
+        self._idle = {} # (scheme, host): [connection, ...]
+        self._lock = threading.Lock()
+
+    def open(self, req):
+        '''Makes the urllib2 request, and returns the response as urllib2
+        would. The response body is read straight away, so that the
+        connection can be reused.'''
+        scheme = req.get_type()
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers['Connection'] = 'keep-alive'
+
+        conn, is_reused = self._get_connection(scheme, host)
+        try:
+            response, body = self._request(conn, req, headers)
+        except RequestError, e:
+            conn.close()
+            # The server may have closed the idle connection, so try once
+            # more with a new one - unless the request may have reached the
+            # server, and repeating it could repeat its effect.
+            if not is_reused or not (e.before_sent or
+                                     req.get_method() in IDEMPOTENT_METHODS):
+                raise urllib2.URLError(e.error)
+            log.debug('Reused connection to %s failed (%r) - reconnecting',
+                      host, e.error)
+            conn = self._new_connection(scheme, host)
+            try:
+                response, body = self._request(conn, req, headers)
+            except RequestError, e:
+                conn.close()
+                raise urllib2.URLError(e.error)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(scheme, host, conn)
+
+        result = urllib.addinfourl(StringIO(body), response.msg,
+                                   req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+    def _request(self, conn, req, headers):
+        '''@return (response, body)
+        @raise RequestError if the request fails'''
+        try:
+            conn.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+        except (httplib.HTTPException, socket.error), e:
+            raise RequestError(e, before_sent=True)
+        try:
+            response = conn.getresponse()
+            return response, response.read()
+        except (httplib.HTTPException, socket.error), e:
+            raise RequestError(e, before_sent=False)
+
+    def _get_connection(self, scheme, host):
+        '''@return (connection, is_reused)'''
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(scheme, host), False
+
+    def _new_connection(self, scheme, host):
+        connection_class = httplib.HTTPSConnection if scheme == 'https' \
+                           else httplib.HTTPConnection
+        kwargs = {'timeout': self.timeout} if self.timeout else {}
+        with self._lock:
+            self.num_connections_made += 1
+        return connection_class(host, **kwargs)
+
+    def _put_connection(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        '''Closes all the idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pool.open(req)
+
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    def __init__(self, pool):
+        urllib2.HTTPSHandler.__init__(self)
+        self.pool = pool
+
+    def https_open(self, req):
+        return self.pool.open(req)
+
+
+def build_pooled_opener(pool, *handlers):
+    '''Returns a urllib2 opener which uses the ConnectionPool. Any other
+    handlers (e.g. for authentication) are added to it too.'''
+    return urllib2.build_opener(KeepAliveHTTPHandler(pool),
+                                KeepAliveHTTPSHandler(pool),
+                                *handlers)
+
+def install_pooled_transport(pool_size=4, timeout=None, base_location=None,
+                             http_user=None, http_pass=None):
+    '''Makes all urllib2 requests in the process (and therefore all
+    ckanclient requests) use a ConnectionPool, which is returned.
+
+    A ckanclient created with http_user/http_pass installs its own opener
+    for HTTP Basic Authentication, so supply them here too, and
+    reinstall pool.opener after creating any more such ckanclients.
+    '''
+    pool = ConnectionPool(pool_size=pool_size, timeout=timeout)
+    handlers = []
+    if http_user and http_pass:
+        password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        password_mgr.add_password(None, base_location, http_user, http_pass)
+        handlers.append(urllib2.HTTPBasicAuthHandler(password_mgr))
+    pool.opener = build_pooled_opener(pool, *handlers)
+    urllib2.install_opener(pool.opener)
+    return pool
@@ -0,0 +1,119 @@
+'''
+An on-disk record of the packages loaded by PackageLoader.load_packages,
+so that a run which is interrupted can be resumed without searching for,
+getting and comparing the packages that were already loaded.
+
+Each pkg_dict is identified by the loader's identity for it (e.g. its name,
+or the value of its unique extra field) plus a hash of its content, so a
+pkg_dict that has changed since it was recorded is loaded again.
+
+The journal is a file of JSON lines, only ever appended to. Lines are
+flushed to the OS as they are written, and fsync'd in batches, so a
+crash loses at most the last batch (whose packages are simply loaded
+again on resume).
+
+    journal = LoadJournal('load.journal')
+    try:
+        loader.load_packages(pkg_dicts, journal=journal)
+    finally:
+        journal.close()
+'''
+import os
+import json
+import time
+import threading
+
+log = __import__("logging").getLogger(__name__)
+
+class LoadJournal(object):
+    '''
+    @param filepath - journal file, which is created or appended to
+    @param sync_every - fsync after this many records
+    @param sync_interval - fsync if it is this many seconds since the last
+    '''
+    def __init__(self, filepath, sync_every=100, sync_interval=5.0):
+        self.filepath = filepath
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # (identity, content_hash): {'id':..., 'name':...}
+        self._loaded = {}
+        is_line_incomplete = self._read()
+        self._file = open(filepath, 'a')
+        if is_line_incomplete:
+            # so that the next record starts on a line of its own
+            self._file.write('\n')
+        self._num_unsynced = 0
+        self._last_sync = time.time()
+
+    @property
+    def num_loaded(self):
+        with self._lock:
+            return len(self._loaded)
+
+    def _read(self):
+        '''Reads the existing records.
+        @return whether the file ends with an incomplete line'''
+        if not os.path.exists(self.filepath):
+            return False
+        line = ''
+        with open(self.filepath) as f:
+            for line_num, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be incomplete if the run was killed
+                    log.warn('Ignoring unreadable line %i of journal %s',
+                             line_num + 1, self.filepath)
+                    continue
+                self._apply(entry)
+        log.info('Journal %s: %i packages already loaded',
+                 self.filepath, len(self._loaded))
+        return bool(line) and not line.endswith('\n')
+
+    def _apply(self, entry):
+        key = (entry['identity'], entry['hash'])
+        if entry['outcome'] == 'loaded':
+            self._loaded[key] = {'id': entry['id'], 'name': entry['name']}
+        else:
+            self._loaded.pop(key, None)
+
+    def get_loaded(self, identity, content_hash):
+        '''Returns {'id':..., 'name':...} of the package that the pkg_dict
+        was loaded into, or None if it has not been loaded.'''
+        with self._lock:
+            return self._loaded.get((identity, content_hash))
+
+    def record(self, identity, content_hash, outcome, pkg_dict):
+        '''Records the outcome ('loaded', 'error' etc.) of loading a
+        pkg_dict. For 'loaded', pkg_dict is the package that resulted.'''
+        entry = {'identity': identity, 'hash': content_hash,
+                 'outcome': outcome,
+                 'id': pkg_dict.get('id'), 'name': pkg_dict.get('name')}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._apply(entry)
+            self._file.write(line)
+            self._file.flush()
+            self._num_unsynced += 1
+            if self._num_unsynced >= self.sync_every or \
+                   time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        '''Makes sure all records are on disk.'''
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._num_unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._num_unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
@@ -9,21 +9,135 @@ import copy
 from traceback import format_exc
 from pprint import pformat
 import itertools
+import threading
+import Queue
+from collections import OrderedDict
+import hashlib
+import json
+import logging
 
+from metrics import LoaderMetrics
 from ckanclient import CkanApiError, CkanApiNotAuthorizedError
+try:
+    from ckanclient import CkanApiActionError
+except ImportError:
+    # older ckanclient, without the Action API
+    CkanApiActionError = CkanApiError
 
 PACKAGE_NAME_MAX_LENGTH = 100 # this should match with ckan/model/package.py
                               # but we avoid requiring ckan in this loader.
 
 ACTIVE = 'active'             # should match ckan.model.ACTIVE
+
+NAME_CLASH_SEARCH_DEPTH = 50  # number of alternative names to look for in
+                              # one search, when the preferred one is taken
+
+WRITE_ACTIONS = ('create', 'update', 'no change') # actions of planned
+                              # operations that execute() carries out
                               
-log = __import__("logging").getLogger(__name__)
+log = logging.getLogger(__name__)
+
+def solr_escape(value):
+    '''Escapes the characters that are special in a SOLR query. (Values
+    which are not strings, e.g. ints or dates from a spreadsheet, are
+    converted.)'''
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return re.sub(r'([+\-!(){}\[\]^"~*?:\\/&|])', r'\\\1', value)
 
 class LoaderError(Exception):
     pass
 
+class PackageCache(object):
+    '''Least-recently-used cache of package dicts, which can be looked up
+    by package name or id. It is thread-safe, and it stores and returns
+    copies, so callers are free to change the dicts.'''
+    def __init__(self, size):
+        assert size > 0, size
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._pkgs = OrderedDict() # pkg_name: pkg, least recently used first
+        self._names_by_id = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pkgs)
+
+    def get(self, pkg_ref, metadata_modified=None):
+        '''Returns a copy of the cached package, or None. If the
+        metadata_modified of the package on the server is known, then the
+        cached package is only returned if it matches.'''
+        with self._lock:
+            pkg_name = self._names_by_id.get(pkg_ref, pkg_ref)
+            pkg = self._pkgs.pop(pkg_name, None)
+            if pkg is not None and metadata_modified and \
+                   pkg.get('metadata_modified') != metadata_modified:
+                log.debug('Cached package %r is out of date', pkg_name)
+                self._names_by_id.pop(pkg.get('id'), None)
+                pkg = None
+            if pkg is None:
+                self.misses += 1
+                return None
+            self._pkgs[pkg_name] = pkg
+            self.hits += 1
+            return copy.deepcopy(pkg)
+
+    def put(self, pkg, keep_newer=False):
+        '''Adds the package, replacing any existing version of it.
+        @param keep_newer - if True, an existing version with a later
+                            metadata_modified is kept instead
+        @return a copy of the version of the package now cached
+        '''
+        pkg = copy.deepcopy(pkg)
+        with self._lock:
+            cached_pkg = self._pkgs.pop(pkg['name'], None)
+            if keep_newer and cached_pkg is not None and \
+                   (cached_pkg.get('metadata_modified') or '') > \
+                   (pkg.get('metadata_modified') or ''):
+                pkg = cached_pkg
+            self._pkgs[pkg['name']] = pkg
+            if pkg.get('id'):
+                self._names_by_id[pkg['id']] = pkg['name']
+            while len(self._pkgs) > self.size:
+                old_name, old_pkg = self._pkgs.popitem(last=False)
+                self._names_by_id.pop(old_pkg.get('id'), None)
+            return copy.deepcopy(pkg)
+
+    def invalidate(self, pkg_ref):
+        with self._lock:
+            pkg_name = self._names_by_id.pop(pkg_ref, pkg_ref)
+            pkg = self._pkgs.pop(pkg_name, None)
+            if pkg is not None:
+                self._names_by_id.pop(pkg.get('id'), None)
+
+class KeyedLocks(object):
+    '''A lock for each key, so that threads doing work for the same key
+    (e.g. loading the same package) take turns. A key's lock is dropped
+    when no thread holds it or waits for it.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {} # key: [lock, number of threads using it]
+
+    def acquire(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key):
+        with self._lock:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
 class PackageLoader(object):
-    def __init__(self, ckanclient, stats=None):
+    def __init__(self, ckanclient, stats=None, cache_size=1000,
+                 fingerprint_extra_key=None, minimal_updates=False,
+                 defer_group_writes=False, scheduler=None, metrics=None):
         '''
         Loader for packages into a CKAN server. Takes package dictionaries
         and loads them using the ckanclient. Can also add packages to a
@@ -36,72 +150,516 @@ class PackageLoader(object):
 
         @param ckanclient - ckanclient object, which contains the
                             connection to CKAN server
+        @param cache_size - the number of packages to keep in an in-memory
+                            cache, to save getting the same package from
+                            the server repeatedly. 0 disables the cache.
+        @param fingerprint_extra_key - if set (e.g. 'import_fingerprint'),
+                            a hash of each pkg_dict is stored in this
+                            extra when it is written. When reloading, if
+                            the hash of the pkg_dict matches the one known
+                            for the existing package (from the search
+                            result or index), then it is deemed unchanged
+                            without comparing the package (or writing it).
+                            (Going by the index, the package is still got,
+                            if not cached, to return it.)
+        @param minimal_updates - if True, updates only send the fields that
+                            have changed, and changed resources are written
+                            individually where the server has the Action
+                            API. If that fails it falls back to writing the
+                            whole package.
+        @param defer_group_writes - if True, add_pkgs_to_group just records
+                            the memberships, and they are written once per
+                            group by flush_group_writes, which is called at
+                            the end of load_packages.
+        @param scheduler - a RequestScheduler (see scheduler.py) which
+                            paces the requests made with the ckanclient(s)
+                            and retries failed reads.
+        @param metrics - a LoaderMetrics (see metrics.py) to record the
+                            timings of the phases of loading, and the API
+                            calls made in each. By default the loader has
+                            its own, as loader.metrics.
         '''
         # Note: we pass in the ckanclient (rather than deriving from it), so
         # that we can choose to pass a test client instead of a real one.
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._scheduler = scheduler
+        self.metrics = metrics or LoaderMetrics()
         self.ckanclient = ckanclient
         self._stats = stats
+        self._index = None # see build_index
+        self._cache = PackageCache(cache_size) if cache_size else None
+        self._claimed_pkg_names = set() # names taken by packages this run
+        self.fingerprint_extra_key = fingerprint_extra_key
+        self.minimal_updates = minimal_updates
+        self.defer_group_writes = defer_group_writes
+        self._pending_group_memberships = OrderedDict() # group: [pkg_name]
+        self._member_create_is_available = True
+
+    @property
+    def ckanclient(self):
+        '''The ckanclient to use in the current thread. Normally this is the
+        one passed into the constructor, but each worker of a concurrent
+        load_packages has its own, since a ckanclient keeps the last
+        response (last_status, last_message) on itself.'''
+        return getattr(self._local, 'ckanclient', None) or self._ckanclient
+
+    @ckanclient.setter
+    def ckanclient(self, ckanclient):
+        self._ckanclient = self._wrap_ckanclient(ckanclient)
+
+    def _wrap_ckanclient(self, ckanclient):
+        '''Applied to each ckanclient before it is used.'''
+        if self._scheduler:
+            ckanclient = self._scheduler.wrap(ckanclient)
+        return self.metrics.wrap(ckanclient)
     
     def load_package(self, pkg_dict):
         '''
         May raise LoaderError or CkanApiNotAuthorizedError (which implies API
         key is wrong, so stop).
         '''
+        operation = self._plan_package(pkg_dict)
+        return self._execute_operation(operation)
+
+    def _plan_package(self, pkg_dict):
+        '''Works out how to load the package, doing the searches, gets and
+        comparisons needed, but without writing anything. The name of a
+        new package is claimed now though, so that other packages in this
+        run are given different names.
+
+        @return operation - see _prepare_write
 
+        May raise LoaderError or CkanApiNotAuthorizedError.
+        '''
         log.info('..Loading "%s"' % pkg_dict['name'])
         
         # see if the package is already there
-        existing_pkg_name, existing_pkg = self._find_package(pkg_dict)
+        with self.metrics.phase('find'):
+            existing_pkg_name, existing_pkg = self._find_package(pkg_dict)
         log.debug('Check for dataset already existing: %s', existing_pkg_name)
 
+        if self.fingerprint_extra_key:
+            fingerprint = self._pkg_fingerprint(pkg_dict)
+            if existing_pkg_name:
+                with self.metrics.phase('fingerprint'):
+                    unchanged_pkg = self._find_package_by_fingerprint(
+                        existing_pkg_name, existing_pkg, fingerprint)
+                if unchanged_pkg:
+                    log.info('..No change (fingerprint matches)')
+                    return {'action': 'no change', 'name': existing_pkg_name,
+                            'pkg_dict': pkg_dict, 'pkg': unchanged_pkg}
+
         # if creating a new package, check the name is available
         if not existing_pkg_name:
-            self._ensure_pkg_name_is_available(pkg_dict)
+            with self.metrics.phase('ensure_name'):
+                self._ensure_pkg_name_is_available(pkg_dict)
 
-        # write package
-        # (May raise LoaderError or CkanApiNotAuthorizedError)
-        pkg_dict = self._write_package(pkg_dict, existing_pkg_name, existing_pkg)
-        pkg_dict = self.ckanclient.last_message
+        if self.fingerprint_extra_key:
+            pkg_dict = pkg_dict.copy()
+            pkg_dict['extras'] = dict(pkg_dict.get('extras') or {})
+            pkg_dict['extras'][self.fingerprint_extra_key] = fingerprint
+
+        return self._prepare_write(pkg_dict, existing_pkg_name, existing_pkg)
+
+    def _execute_operation(self, operation):
+        '''Carries out an operation returned by _plan_package.
+
+        @return pkg_dict - the package as it was written (or as it is on the
+                           server already, if it did not need changing)
+
+        May raise LoaderError or CkanApiNotAuthorizedError.
+        '''
+        pkg_dict = self._apply_write(operation)
+        # (with no change, the package's index entry is up to date)
+        if self._index is not None and operation['action'] != 'no change':
+            self._index_package(pkg_dict)
+        with self._lock:
+            self._claimed_pkg_names.add(pkg_dict['name'])
         
         log.debug('Package written: %s %r', pkg_dict['name'], pkg_dict)
         return pkg_dict
 
-    def load_packages(self, pkg_dicts):
+    def load_packages(self, pkg_dicts, workers=None, ckanclient_factory=None,
+                      journal=None):
         '''Loads multiple packages.
 
+        @param workers - if more than 1, the packages are loaded concurrently
+                         by this many worker threads. This is worth doing
+                         when the run time is dominated by the latency of
+                         the API calls.
+        @param ckanclient_factory - callable returning a new ckanclient. It
+                         is required when there are several workers, since
+                         each worker needs its own ckanclient.
+        @param journal - a LoadJournal. pkg_dicts it records as loaded
+                         already are skipped (but included in the results)
+                         and the outcome for each of the rest is recorded.
         @return results and resulting package names/ids.
         '''
+        outcomes = self._load_packages_outcomes(pkg_dicts, workers,
+                                                ckanclient_factory, journal)
+        if self.defer_group_writes:
+            self.flush_group_writes()
+        if journal:
+            journal.sync()
+        return self._summarise_outcomes(
+            [outcomes[index] for index in sorted(outcomes)])
+
+    def _load_packages_outcomes(self, pkg_dicts, workers, ckanclient_factory,
+                                journal):
+        '''Loads the pkg_dicts.
+        @return {index of pkg_dict: (outcome, pkg_dict)} for those done
+        '''
+        return self._run_for_outcomes(
+            lambda pkg_dict: self._load_package_outcome(pkg_dict, journal),
+            pkg_dicts, workers, ckanclient_factory,
+            key=self._concurrency_key)
+
+    def _concurrency_key(self, pkg_dict):
+        '''Returns the package's identity, since two workers loading the
+        same package at once would both find it missing and create it
+        twice. (None if it has no identity, which is an error anyway.)'''
+        try:
+            return self._pkg_identity(pkg_dict)
+        except LoaderError:
+            return None
+
+    def plan(self, pkg_dicts, workers=None, ckanclient_factory=None):
+        '''Works out what load_packages would do with the pkg_dicts, without
+        writing anything. This can be reviewed as a dry run, and then be
+        carried out with execute(). (If packages are changed on the server
+        in between, those changes are overwritten.)
+
+        Where several pkg_dicts are for the same package, they are combined
+        into the first one's operation, so that each package is written
+        only once.
+
+        @param workers, ckanclient_factory - as for load_packages, to do the
+                         searches and gets concurrently.
+        @return plan - a list of operations (JSON-serialisable dicts), one
+                       for each pkg_dict, in order. Each has an 'action':
+                       'create', 'update', 'no change', 'combined' (into
+                       the earlier operation numbered 'into'), 'error' or
+                       'fatal' (the last, since planning then stops).
+        '''
+        with self._lock:
+            claimed_pkg_names = set(self._claimed_pkg_names)
+        try:
+            outcomes = self._run_for_outcomes(self._plan_package_outcome,
+                                              pkg_dicts, workers,
+                                              ckanclient_factory)
+        finally:
+            # nothing is written, so the names claimed for new packages
+            # are free again (the claims only keep them apart in the plan)
+            with self._lock:
+                self._claimed_pkg_names.intersection_update(
+                    claimed_pkg_names)
+        operations = [outcomes[index][1] for index in sorted(outcomes)]
+        self._combine_operations(operations)
+        return operations
+
+    def execute(self, plan, workers=None, ckanclient_factory=None):
+        '''Writes the packages, as planned by plan().
+
+        @param workers, ckanclient_factory - as for load_packages. Since
+                         each package is written by only one operation,
+                         these can be done concurrently.
+        @return results and resulting package names/ids, as for
+                load_packages.
+        '''
+        writes = [(index, operation) for index, operation in enumerate(plan)
+                  if operation['action'] in WRITE_ACTIONS]
+        outcomes = self._run_for_outcomes(
+            lambda write: self._execute_operation_outcome(write[1]),
+            writes, workers, ckanclient_factory)
+        outcomes = dict((writes[write_index][0], outcome)
+                        for write_index, outcome in outcomes.items())
+        if len(outcomes) == len(writes):
+            # all written, so include the rest of the plan
+            for index, operation in enumerate(plan):
+                if operation['action'] in ('error', 'fatal'):
+                    outcomes[index] = (operation['action'],
+                                       operation['pkg_dict'])
+                elif operation['action'] == 'combined':
+                    outcome = outcomes.get(operation['into'])
+                    if outcome and outcome[0] == 'loaded':
+                        self._add_stat('Combined with another dataset',
+                                       operation['pkg_dict'])
+                        self.metrics.count_outcome('combined')
+                        outcomes[index] = outcome
+        if self.defer_group_writes:
+            self.flush_group_writes()
+        return self._summarise_outcomes(
+            [outcomes[index] for index in sorted(outcomes)])
+
+    def _load_package_outcome(self, pkg_dict, journal=None):
+        '''Loads a package, dealing with any LoaderError.
+
+        @return (outcome, pkg_dict) - outcome is one of 'loaded', 'error' or
+                                      'fatal' (which means stop loading)
+        '''
+        journal_key = None
+        if journal:
+            journal_key = self._journal_key(pkg_dict)
+            loaded_pkg = journal_key and journal.get_loaded(*journal_key)
+            if loaded_pkg:
+                log.info('Already loaded (journal): %s', loaded_pkg['name'])
+                self._add_stat('Already loaded', pkg_dict)
+                self.metrics.count_outcome('skipped')
+                return ('loaded', loaded_pkg)
+        try:
+            pkg_dict = self.load_package(pkg_dict)
+        except CkanApiNotAuthorizedError, e:
+            log.error('Authorization Error (fatal) loading dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Authorization Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            return ('fatal', pkg_dict)
+        except LoaderError, e:
+            log.error('Error loading dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            if journal_key:
+                journal.record(journal_key[0], journal_key[1], 'error',
+                               pkg_dict)
+            return ('error', pkg_dict)
+        if journal_key:
+            journal.record(journal_key[0], journal_key[1], 'loaded', pkg_dict)
+        return ('loaded', pkg_dict)
+
+    def _plan_package_outcome(self, pkg_dict):
+        '''Plans the loading of a package, dealing with any LoaderError.
+
+        @return (outcome, operation) - outcome is one of 'planned', 'error'
+                                       or 'fatal' (which means stop)
+        '''
+        try:
+            # (before planning, since that may change the name)
+            identity = self._pkg_identity(pkg_dict)
+            operation = self._plan_package(pkg_dict)
+        except CkanApiNotAuthorizedError, e:
+            log.error('Authorization Error (fatal) planning dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Authorization Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            return ('fatal', {'action': 'fatal', 'message': str(e),
+                              'pkg_dict': pkg_dict})
+        except LoaderError, e:
+            log.error('Error planning dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            return ('error', {'action': 'error', 'message': str(e),
+                              'pkg_dict': pkg_dict})
+        operation['identity'] = identity
+        return ('planned', operation)
+
+    def _execute_operation_outcome(self, operation):
+        '''Carries out a planned operation, dealing with any LoaderError.
+
+        @return (outcome, pkg_dict) - as for _load_package_outcome
+        '''
+        pkg_dict = operation['pkg_dict']
+        try:
+            pkg_dict = self._execute_operation(operation)
+        except CkanApiNotAuthorizedError, e:
+            log.error('Authorization Error (fatal) writing dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Authorization Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            return ('fatal', pkg_dict)
+        except LoaderError, e:
+            log.error('Error writing dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
+            self._add_stat('Error %s' % e, pkg_dict)
+            self.metrics.count_error(e)
+            return ('error', pkg_dict)
+        return ('loaded', pkg_dict)
+
+    def _combine_operations(self, operations):
+        '''Where several operations would write the same package, combines
+        the later ones into the first, with the same result as writing them
+        in turn. (Unlike when loading, the later ones can't find the package
+        written by the first.)
+
+        @return nothing - changes the operations list itself
+        '''
+        first_index_by_target = {}
+        for index, operation in enumerate(operations):
+            if operation['action'] not in WRITE_ACTIONS:
+                continue
+            targets = [('identity', operation['identity'])]
+            if operation['action'] != 'create':
+                targets.append(('name', operation['name']))
+            first_indexes = [first_index_by_target[target]
+                             for target in targets
+                             if target in first_index_by_target]
+            if not first_indexes:
+                for target in targets:
+                    first_index_by_target[target] = index
+                continue
+            first_index = first_indexes[0]
+            self._combine_operation(operations[first_index], operation)
+            operations[index] = {'action': 'combined', 'into': first_index,
+                                 'name': operations[first_index]['name'],
+                                 'pkg_dict': operation['pkg_dict']}
+
+    def _combine_operation(self, first, later):
+        '''Changes the first operation to write the later one's pkg_dict
+        too.'''
+        if later['action'] == 'create':
+            # it will not need the name it was given
+            with self._lock:
+                self._claimed_pkg_names.discard(later['name'])
+        if first['action'] == 'no change':
+            planned_pkg = first['pkg']
+        else:
+            planned_pkg = first['pkg_dict']
+        combined = self._prepare_write(later['pkg_dict'], first['name'],
+                                       copy.deepcopy(planned_pkg))
+        if combined['action'] == 'no change':
+            return
+        if first['action'] == 'no change':
+            first['action'] = 'update'
+            first['existing_pkg'] = first.pop('pkg')
+        first['pkg_dict'] = combined['pkg_dict']
+
+    def _journal_key(self, pkg_dict):
+        '''Returns (identity, content_hash) for the pkg_dict, or None if
+        it lacks the values that identify it. This is calculated before
+        loading, since loading may change the pkg_dict's name.'''
+        try:
+            return (self._pkg_identity(pkg_dict),
+                    self._pkg_fingerprint(pkg_dict))
+        except LoaderError:
+            return None
+
+    def _pkg_identity(self, pkg_dict):
+        '''Returns a string which identifies the package that the pkg_dict
+        is for, and which is stable between runs.'''
+        search_options = self._identity_search_options(pkg_dict)
+        return json.dumps(dict((key, self.lower(value))
+                               for key, value in search_options.items()),
+                          sort_keys=True)
+
+    def _identity_search_options(self, pkg_dict):
+        # (the basic search options, i.e. without any synonyms)
+        return PackageLoader._get_search_options(
+            self, self._identity_field_keys(), pkg_dict)
+
+    def _identity_field_keys(self):
+        return ['name']
+
+    def _summarise_outcomes(self, outcomes):
         num_errors = 0
         num_loaded = 0
         pkg_ids = []
         pkg_names = []
-        for pkg_dict in pkg_dicts:
-            try:
-                pkg_dict = self.load_package(pkg_dict)
-            except CkanApiNotAuthorizedError, e:
-                log.error('Authorization Error (fatal) loading dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
-                num_errors = 'fatal'
-                self._add_stat('Authorization Error %s' % e, pkg_dict)
-                break
-            except LoaderError, e:
-                log.error('Error loading dict "%s":\n%s' % (pkg_dict['name'], format_exc()))
-                num_errors += 1
-                self._add_stat('Error %s' % e, pkg_dict)
-            else:
+        for outcome, pkg_dict in outcomes:
+            if outcome == 'loaded':
                 pkg_ids.append(pkg_dict['id'])
                 pkg_names.append(pkg_dict['name'])
                 num_loaded += 1
+            elif outcome == 'error' and num_errors != 'fatal':
+                num_errors += 1
+            elif outcome == 'fatal':
+                num_errors = 'fatal'
         return {'pkg_names':pkg_names,
                 'pkg_ids':pkg_ids,
                 'num_loaded':num_loaded,
                 'num_errors':num_errors}
 
+    def _run_for_outcomes(self, function, items, workers,
+                          ckanclient_factory, key=None):
+        '''Calls the function for each item, in turn or using a pool of
+        worker threads. Stops after the first 'fatal' outcome.
+
+        @param function - takes an item and returns (outcome, value)
+        @param key - takes an item and returns a key (or None). Workers do
+                     not call the function for items with the same key at
+                     the same time.
+        @return {index of item: (outcome, value)} for the items done
+        '''
+        if workers and workers > 1:
+            return self._run_concurrently(function, items, workers,
+                                          ckanclient_factory, key)
+        outcomes = {}
+        for index, item in enumerate(items):
+            outcomes[index] = function(item)
+            if outcomes[index][0] == 'fatal':
+                break
+        return outcomes
+
+    def _run_concurrently(self, function, items, workers, ckanclient_factory,
+                          key=None):
+        '''Calls the function for each item using a pool of worker threads,
+        each with its own ckanclient. items are read lazily, so it can be a
+        generator. All workers stop after the first 'fatal' outcome.
+
+        @return {index of item: (outcome, value)} for the items done
+        '''
+        assert ckanclient_factory, 'Need a ckanclient_factory to give ' \
+               'each worker its own ckanclient'
+        queue = Queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        outcomes = {}
+        exceptions = []
+        key_locks = KeyedLocks()
+
+        def work():
+            try:
+                self._local.ckanclient = \
+                    self._wrap_ckanclient(ckanclient_factory())
+            except Exception:
+                exceptions.append(format_exc())
+                stop.set()
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if stop.is_set():
+                    # keep draining the queue so that the feeder can finish
+                    continue
+                index, item = item
+                try:
+                    item_key = key(item) if key else None
+                    if item_key is not None:
+                        key_locks.acquire(item_key)
+                    try:
+                        outcome = function(item)
+                    finally:
+                        if item_key is not None:
+                            key_locks.release(item_key)
+                except Exception:
+                    exceptions.append(format_exc())
+                    stop.set()
+                    continue
+                outcomes[index] = outcome
+                if outcome[0] == 'fatal':
+                    stop.set()
+
+        threads = [threading.Thread(target=work, name='loader-%i' % i)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for index, item in enumerate(items):
+                if stop.is_set():
+                    break
+                queue.put((index, item))
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        if exceptions:
+            raise LoaderError('Unexpected exception in loader worker:\n%s' % \
+                              exceptions[0])
+        return outcomes
+
     def _add_stat(self, message, pkg_dict):
         if not self._stats:
             return
         pub_date = pkg_dict.get('extras', {}).get('date_released')
         item_id = '%s (%s)' % (pkg_dict['title'], pub_date)
-        return self._stats.add(message, item_id)
+        with self._lock:
+            return self._stats.add(message, item_id)
 
     def _find_package(self, pkg_dict):
         raise NotImplemented
@@ -112,46 +670,180 @@ class PackageLoader(object):
         be changed, then supply existing_pkg_name. If the caller has already
         got the existing package then pass it in, to save getting it twice.
 
-        @return pkg_dict - the package as it was written
+        @return pkg_dict - the package as it was written (or as it is on the
+                           server already, if it did not need changing)
 
         May raise LoaderError or CkanApiNotAuthorizedError (which implies API
         key is wrong, so stop).
         '''
+        operation = self._prepare_write(pkg_dict, existing_pkg_name,
+                                        existing_pkg)
+        return self._apply_write(operation)
+
+    def _prepare_write(self, pkg_dict, existing_pkg_name, existing_pkg=None):
+        '''Works out how to write a package (pkg_dict) - the first half of
+        _write_package, which does no writes.
+
+        @return operation - a dict with an 'action' of:
+                   'create' - pkg_dict is to be created
+                   'update' - pkg_dict is to be written over 'existing_pkg'
+                   'no change' - the package is already 'pkg'
+                 and 'name' of the package.
+        '''
         if existing_pkg_name:
             if not existing_pkg:
-                existing_pkg = self._get_package(existing_pkg_name)
+                with self.metrics.phase('get'):
+                    existing_pkg = self._get_package(existing_pkg_name)
             if existing_pkg_name != pkg_dict["name"]:
                 pkg_dict = pkg_dict.copy()
                 pkg_dict["name"] = existing_pkg_name
-            if self._pkg_has_changed(existing_pkg, pkg_dict):
-                log.info('..Updating existing package')
-                try:
-                    self.ckanclient.package_entity_put(pkg_dict)
-                except CkanApiError:
-                    raise LoaderError(
-                        'Error (%s) editing package over API: %s' % \
-                        (self.ckanclient.last_status,
-                         self.ckanclient.last_message))
-                pkg_dict = self.ckanclient.last_message
-                self._add_stat('Updated package', pkg_dict)
+            with self.metrics.phase('compare'):
+                has_changed = self._pkg_has_changed(existing_pkg, pkg_dict)
+            if has_changed:
+                return {'action': 'update', 'name': existing_pkg_name,
+                        'pkg_dict': pkg_dict, 'existing_pkg': existing_pkg}
             else:
-                log.info('..No change')
-                self._add_stat('No change', pkg_dict)
+                return {'action': 'no change', 'name': existing_pkg_name,
+                        'pkg_dict': pkg_dict, 'pkg': existing_pkg}
+        return {'action': 'create', 'name': pkg_dict['name'],
+                'pkg_dict': pkg_dict}
+
+    def _apply_write(self, operation):
+        '''Carries out the operation returned by _prepare_write - the second
+        half of _write_package.'''
+        pkg_dict = operation['pkg_dict']
+        if operation['action'] == 'update':
+            log.info('..Updating existing package')
+            with self.metrics.phase('write'):
+                pkg_dict = self._update_package(pkg_dict,
+                                                operation['existing_pkg'])
+            self._add_stat('Updated package', pkg_dict)
+            self.metrics.count_outcome('updated')
+        elif operation['action'] == 'no change':
+            log.info('..No change')
+            self._add_stat('No change', pkg_dict)
+            self.metrics.count_outcome('unchanged')
+            pkg_dict = operation['pkg']
         else:
             log.info('..Creating package')
             try:
-                self.ckanclient.package_register_post(pkg_dict)
+                with self.metrics.phase('write'):
+                    self.ckanclient.package_register_post(pkg_dict)
             except CkanApiNotAuthorizedError:
+                self._release_pkg_name(pkg_dict['name'])
                 raise
             except CkanApiError:
+                self._release_pkg_name(pkg_dict['name'])
                 raise LoaderError(
                     'Error (%s) creating package over API: %s' % \
                     (self.ckanclient.last_status,
                      self.ckanclient.last_message))
             pkg_dict = self.ckanclient.last_message
+            self._cache_package(pkg_dict)
             self._add_stat('Created package', pkg_dict)
+            self.metrics.count_outcome('created')
+        return pkg_dict
+
+    def _update_package(self, pkg_dict, existing_pkg):
+        '''Writes pkg_dict over the existing package.
+        @return the package as written
+        '''
+        if self.minimal_updates:
+            try:
+                return self._patch_package(pkg_dict, existing_pkg)
+            except (CkanApiError, CkanApiActionError), e:
+                log.warn('Minimal update of package %r failed (status %s), '
+                         'so writing all of it: %r', existing_pkg['name'],
+                         self.ckanclient.last_status, e.args)
+                self._cache_package(None, existing_pkg['name'])
+        try:
+            self.ckanclient.package_entity_put(pkg_dict)
+        except CkanApiError:
+            self._cache_package(None, existing_pkg['name'])
+            raise LoaderError(
+                'Error (%s) editing package over API: %s' % \
+                (self.ckanclient.last_status,
+                 self.ckanclient.last_message))
+        pkg_dict = self.ckanclient.last_message
+        self._cache_package(pkg_dict)
         return pkg_dict
 
+    def _patch_package(self, pkg_dict, existing_pkg):
+        '''Writes just the differences between pkg_dict and the existing
+        package. This relies on the REST API leaving alone the fields that
+        are not sent.
+        @return the package as written
+        '''
+        changed_fields, resource_changes = \
+                        self._diff_package(existing_pkg, pkg_dict)
+        for existing_res, res in resource_changes:
+            if existing_res:
+                log.info('..Updating resource %s', existing_res['id'])
+                self.ckanclient.action('resource_update',
+                                       **dict(res, id=existing_res['id']))
+            else:
+                log.info('..Adding resource %s', res.get('url'))
+                self.ckanclient.action('resource_create',
+                                       **dict(res, package_id=existing_pkg['id']))
+        if changed_fields:
+            log.info('..Updating fields: %s', ', '.join(sorted(changed_fields)))
+            changed_fields['name'] = existing_pkg['name']
+            self.ckanclient.package_entity_put(
+                changed_fields, package_name=existing_pkg['name'])
+            pkg = self.ckanclient.last_message
+            self._cache_package(pkg)
+        else:
+            # the resource writes don't return the package, so get it
+            self._cache_package(None, existing_pkg['name'])
+            pkg = self._get_package(existing_pkg['name'])
+        return pkg
+
+    def _diff_package(self, existing_pkg, pkg_dict):
+        '''Works out which parts of pkg_dict differ from the existing
+        package.
+
+        @return (changed_fields, resource_changes)
+                changed_fields - dict of the top-level fields that have
+                                 changed, with their new values. Extras
+                                 are all included if any has changed.
+                resource_changes - list of (existing_res, res) for the
+                                 resources to be written individually,
+                                 where existing_res is None for a new
+                                 resource
+        '''
+        changed_fields = {}
+        for key, value in pkg_dict.items():
+            if key in self._keys_to_ignore_when_comparing() or \
+                   key in ('name', 'resources'):
+                continue
+            if self._pkg_has_changed(existing_pkg.get(key), value):
+                changed_fields[key] = value
+
+        resource_changes = []
+        resources = pkg_dict.get('resources')
+        existing_resources = existing_pkg.get('resources') or []
+        if resources is not None and \
+               self._pkg_has_changed(existing_resources, resources):
+            # Resources can be written individually if they are only
+            # changed or added (not removed or reordered)
+            if hasattr(self.ckanclient, 'action') and \
+                   existing_pkg.get('id') and \
+                   len(resources) >= len(existing_resources) and \
+                   all(res.get('id') for res in existing_resources):
+                for i, res in enumerate(resources):
+                    if i >= len(existing_resources):
+                        resource_changes.append((None, res))
+                    elif res.get('id') not in (None, existing_resources[i]['id']):
+                        # reordered
+                        resource_changes = []
+                        changed_fields['resources'] = resources
+                        break
+                    elif self._pkg_has_changed(existing_resources[i], res):
+                        resource_changes.append((existing_resources[i], res))
+            else:
+                changed_fields['resources'] = resources
+        return changed_fields, resource_changes
+
     def add_pkg_to_group(self, pkg_name, group_name):
         return self.add_pkgs_to_group([pkg_name], group_name)
 
@@ -159,20 +851,91 @@ class PackageLoader(object):
         for pkg_name in pkg_names:
             assert not self.ckanclient.is_id(pkg_name), pkg_name
         assert not self.ckanclient.is_id(group_name), group_name
+        if self.defer_group_writes:
+            with self._lock:
+                pending_pkg_names = self._pending_group_memberships.\
+                                    setdefault(group_name, [])
+                for pkg_name in pkg_names:
+                    if pkg_name not in pending_pkg_names:
+                        pending_pkg_names.append(pkg_name)
+            return
+        with self.metrics.phase('group_write'):
+            self._write_group_memberships(group_name, pkg_names)
+
+    def flush_group_writes(self):
+        '''Writes the group memberships recorded by add_pkgs_to_group when
+        defer_group_writes is set - once per group.
+        May raise LoaderError, after attempting all the groups.
+        '''
+        with self._lock:
+            pending = self._pending_group_memberships
+            self._pending_group_memberships = OrderedDict()
+        errors = []
+        for group_name, pkg_names in pending.items():
+            try:
+                with self.metrics.phase('group_write'):
+                    self._write_group_memberships(group_name, pkg_names)
+            except LoaderError, e:
+                log.error('Error adding packages to group %r: %s',
+                          group_name, e)
+                errors.append(str(e))
+        if errors:
+            raise LoaderError('; '.join(errors))
+
+    def _write_group_memberships(self, group_name, pkg_names):
+        '''Adds the packages to the group, unless they are already in it.'''
         try:
             group_dict = self.ckanclient.group_entity_get(group_name)
         except CkanApiError, e:
             if self.ckanclient.last_status == 404:
                 raise LoaderError('Group named %r does not exist' % group_name)
             else:
-                raise LoaderError('Unexpected status (%s) checking for group name %r: %r') % (self.ckanclient.last_status, group_name, group_dict)
-        group_dict['packages'] = (group_dict['packages'] or []) + pkg_names
+                raise LoaderError('Unexpected status (%s) checking for group name %r: %r' % (self.ckanclient.last_status, group_name, e.args))
+        existing_pkg_names = group_dict['packages'] or []
+        new_pkg_names = []
+        for pkg_name in pkg_names:
+            if pkg_name not in existing_pkg_names and \
+                   pkg_name not in new_pkg_names:
+                new_pkg_names.append(pkg_name)
+        if not new_pkg_names:
+            log.info('Packages already in group %r', group_name)
+            return
+        log.info('Adding %i packages to group %r',
+                 len(new_pkg_names), group_name)
+
+        # Adding the members individually saves sending the whole group
+        if self._member_create_is_available and \
+               hasattr(self.ckanclient, 'action'):
+            try:
+                for pkg_name in new_pkg_names:
+                    self.ckanclient.action('member_create', id=group_name,
+                                           object=pkg_name,
+                                           object_type='package',
+                                           capacity='public')
+                return
+            except (CkanApiError, CkanApiActionError), e:
+                log.warn('Could not add group members individually (status '
+                         '%s), so writing the whole group: %r',
+                         self.ckanclient.last_status, e.args)
+                self._member_create_is_available = False
+
+        group_dict['packages'] = existing_pkg_names + new_pkg_names
         try:
             group_dict = self.ckanclient.group_entity_put(group_dict)
         except CkanApiError, e:
             raise LoaderError('Unexpected status %s writing to group \'%s\': %r' % (self.ckanclient.last_status, group_dict, e.args))
 
     def _get_package(self, pkg_name):
+        if self._cache is not None:
+            # if the index says when the package was last modified, make
+            # sure the cached version is no older
+            index_entry = self._index.get(pkg_name) \
+                          if self._index is not None else None
+            pkg = self._cache.get(pkg_name, index_entry and \
+                                  index_entry.get('metadata_modified'))
+            self.metrics.count_cache_lookup(hit=bool(pkg))
+            if pkg:
+                return pkg
         try:
             pkg = self.ckanclient.package_entity_get(pkg_name)
         except CkanApiError, e:
@@ -180,8 +943,22 @@ class PackageLoader(object):
                 pkg = None
             else:
                 raise LoaderError('Unexpected status %s checking for package under \'%s\': %r' % (self.ckanclient.last_status, pkg_name, e.args))
+        self._cache_package(pkg, pkg_name)
         return pkg
 
+    def _cache_package(self, pkg, pkg_ref=None, keep_newer=False):
+        '''Stores a package dict just received from the server in the
+        cache. If pkg is None, the package under pkg_ref no longer
+        exists.
+        @param keep_newer - see PackageCache.put
+        '''
+        if self._cache is None:
+            return
+        if pkg:
+            self._cache.put(pkg, keep_newer)
+        elif pkg_ref:
+            self._cache.invalidate(pkg_ref)
+
     def _find_package_by_fields(self, field_keys, pkg_dict):
         '''Looks for a package that has matching keys to the pkg supplied.
         Requires a unique match or it raises LoaderError.
@@ -192,33 +969,77 @@ class PackageLoader(object):
                                   otherwise None
         '''
         if field_keys == ['name']:
+            search_options = {'name': pkg_dict['name']}
             pkg = self._get_package(pkg_dict['name'])
             pkg_name = pkg_dict['name'] if pkg else None
         else:
             search_options = self._get_search_options(field_keys, pkg_dict)
             pkg_name, pkg = self._find_package_by_options(search_options)
 
-        if not pkg_name:
+        if not pkg_name and field_keys != ['name']:
             # Just in case search is not being well indexed, look for the
             # package under its name as well
-            try_pkg_name = pkg_dict['name']
-            pkg = self._get_package(try_pkg_name)
-            while pkg:
-                if self._pkg_matches_search_options(pkg, search_options):
-                    log.warn('Search failed to find package %r with ref %r, '
-                             'but luckily the name is what was expected so loader '
-                             'found it anyway.' % (pkg_dict['name'], search_options))
-                    pkg_name = try_pkg_name
-                    break
-                try_pkg_name += '_'
-                pkg = self._get_package(try_pkg_name)
-            else:
-                pkg_name = pkg = None
+            pkg_name, pkg = self._find_package_by_name_probing(pkg_dict,
+                                                               search_options)
 
         log.info('..Search for existing package found: %r with filter: %r',
                  pkg_name, search_options)
         return pkg_name, pkg 
 
+    def _find_package_by_name_probing(self, pkg_dict, search_options):
+        '''Looks for a package matching the search_options under the name
+        of the pkg_dict, and the names it would have been given to avoid
+        clashes (with underscores appended).
+        @return (pkg_name, pkg) - or (None, None) if not found
+        '''
+        try_pkg_name = pkg_dict['name']
+        pkg = self._get_package(try_pkg_name)
+        while pkg:
+            if self._pkg_matches_search_options(pkg, search_options):
+                log.warn('Search failed to find package %r with ref %r, '
+                         'but luckily the name is what was expected so loader '
+                         'found it anyway.' % (pkg_dict['name'], search_options))
+                return try_pkg_name, pkg
+            try_pkg_name += '_'
+            pkg = self._get_package(try_pkg_name)
+        return None, None
+
+    def build_index(self, page_size=1000):
+        '''Optional warm-up step, which pages through all the packages on
+        the CKAN server once and indexes them in memory. Subclasses which
+        support it then find existing packages using the index, rather
+        than searching for each one over the API.
+
+        The index is kept up to date with the packages this loader writes.
+        '''
+        log.info('Building index of existing packages')
+        self._index = {}
+        try:
+            with self.metrics.phase('build_index'):
+                res = self.ckanclient.package_search(
+                    q='', search_options={'all_fields': 1,
+                                          'limit': page_size})
+                for pkg in res['results']:
+                    self._index_package(pkg)
+        except CkanApiError, e:
+            self._index = None
+            raise LoaderError('Search request failed (status %s) building '
+                              'the index: %r' % \
+                              (self.ckanclient.last_status, e.args))
+        log.info('Indexed %i packages', len(self._index))
+
+    def _index_package(self, pkg):
+        '''Adds (or updates) a package in the index.'''
+        if pkg.get('state', ACTIVE) != ACTIVE:
+            return
+        with self._lock:
+            self._index[pkg['name']] = {
+                'id': pkg.get('id'),
+                'name': pkg['name'],
+                'metadata_modified': pkg.get('metadata_modified'),
+                'fingerprint': (pkg.get('extras') or {}).get(
+                    self.fingerprint_extra_key)}
+
     def _get_search_options(self, field_keys, pkg_dict):
         search_options = {}
         has_a_value = False
@@ -241,8 +1062,12 @@ class PackageLoader(object):
         return search_options
         
     def _package_search(self, search_options):
+        '''Searches for packages matching the search_options, asking for
+        the full package dicts in the results, to save getting them
+        individually.'''
         try:
-            res = self.ckanclient.package_search(q='', search_options=search_options)
+            res = self.ckanclient.package_search(
+                q='', search_options=dict(search_options, all_fields=1))
         except CkanApiError, e:
             raise LoaderError('Search request failed (status %s): %r' % (self.ckanclient.last_status, e.args))
         return res
@@ -265,26 +1090,37 @@ class PackageLoader(object):
         # Search doesn't do exact match (e.g. sql search searches *in*
         # a field), so check matches thoroughly.
         # Also check the package is active
-        exactly_matching_pkg_names = []
-        pkg = None
+        exactly_matching_pkgs = []
         for pkg_ref in search['results']:
-            pkg = self._get_package(pkg_ref)
-            if pkg['state'] == ACTIVE and \
+            pkg = self._search_result_to_package(pkg_ref)
+            if pkg.get('state', ACTIVE) == ACTIVE and \
                    self._pkg_matches_search_options(pkg, search_options):
-                exactly_matching_pkg_names.append(pkg["name"])
+                exactly_matching_pkgs.append(pkg)
+        exactly_matching_pkg_names = [pkg['name'] for pkg in exactly_matching_pkgs]
         if len(exactly_matching_pkg_names) > 1:
             log.error('More than one record matches the search options %r: %r (so picking the first one)' % (search_options, exactly_matching_pkg_names))
-            pkg_name = exactly_matching_pkg_names[0]
-        elif len(exactly_matching_pkg_names) == 1:
-            pkg_name = exactly_matching_pkg_names[0]
+        if exactly_matching_pkgs:
+            pkg = exactly_matching_pkgs[0]
+            pkg_name = pkg['name']
         else:
-            pkg_name = None
-        # Only carry through value for pkg if it was the last one and only
-        # one fetched
-        if not(search['count'] == 1 and pkg and pkg['name'] == pkg_name):
-            pkg = None
+            pkg_name = pkg = None
         return pkg_name, pkg
 
+    def _search_result_to_package(self, search_result):
+        '''Returns the package dict for a search result. Searches ask for
+        all fields, so it is usually the result itself, but if the server
+        only returned a package name or id then it is got.'''
+        if isinstance(search_result, dict) and 'name' in search_result \
+               and 'extras' in search_result:
+            # (the search index may lag behind a package this loader has
+            # just written, in which case the cached one is newer)
+            if self._cache is not None:
+                return self._cache.put(search_result, keep_newer=True)
+            return search_result
+        if isinstance(search_result, dict):
+            search_result = search_result.get('id') or search_result['name']
+        return self._get_package(search_result)
+
     def _ensure_pkg_name_is_available(self, pkg_dict):
         '''Checks the CKAN db to see if the name for this package has been
         already taken, and if so, changes the pkg_dict to have another
@@ -292,16 +1128,27 @@ class PackageLoader(object):
         @return nothing - changes the name in the pkg_dict itself
         '''
         preferred_name = pkg_dict['name']
-        clashing_pkg = self._get_package(pkg_dict['name'])
-        original_clashing_pkg = clashing_pkg
-        while clashing_pkg:
-            if len(pkg_dict['name']) >= PACKAGE_NAME_MAX_LENGTH:
-                new_name = pkg_dict['name'].rstrip('_')[:-1]
-                new_name = new_name.ljust(PACKAGE_NAME_MAX_LENGTH, '_')
-                pkg_dict['name'] = new_name
-            else:
-                pkg_dict['name'] += '_'
-            clashing_pkg = self._get_package(pkg_dict['name'])
+        known_taken_names = None
+        for name in self._candidate_pkg_names(preferred_name):
+            if name in self._claimed_pkg_names:
+                # a package was written with this name earlier in this run
+                continue
+            if known_taken_names is not None and name in known_taken_names:
+                continue
+            if self._index is not None and name in self._index:
+                continue
+            # confirm the name is free (search does not return deleted
+            # packages, which still take their name)
+            if self._get_package(name):
+                if known_taken_names is None:
+                    # rather than trying the alternatives one at a time,
+                    # find which are taken in one search
+                    known_taken_names = \
+                        self._search_for_taken_pkg_names(preferred_name)
+                continue
+            if self._claim_pkg_name(name):
+                break
+        pkg_dict['name'] = name
 
         if pkg_dict['name'] != preferred_name:
             log.warn('Name %r already exists so new package renamed '
@@ -309,13 +1156,105 @@ class PackageLoader(object):
         else:
             log.debug('Name %r available', pkg_dict['name'])
                 
+    def _candidate_pkg_names(self, preferred_name):
+        '''Generates the names that a new package might take, in order of
+        preference: the preferred name, and then versions with underscores
+        appended (truncated if necessary to fit PACKAGE_NAME_MAX_LENGTH).'''
+        name = preferred_name
+        while True:
+            yield name
+            if len(name) >= PACKAGE_NAME_MAX_LENGTH:
+                name = name.rstrip('_')[:-1]
+                name = name.ljust(PACKAGE_NAME_MAX_LENGTH, '_')
+            else:
+                name += '_'
+
+    def _search_for_taken_pkg_names(self, preferred_name):
+        '''Searches for packages with names that are alternatives for the
+        preferred name.
+        @return set of the package names found
+        '''
+        candidates = list(itertools.islice(
+            self._candidate_pkg_names(preferred_name),
+            NAME_CLASH_SEARCH_DEPTH))
+        # only the candidates can match, so the results fit in one page
+        q = 'name:(%s)' % ' OR '.join('"%s"' % solr_escape(name)
+                                      for name in candidates)
+        try:
+            res = self.ckanclient.package_search(
+                q=q, search_options={'limit': len(candidates)})
+            pkg_names = set(res['results'])
+        except CkanApiError, e:
+            log.warn('Search for alternatives to name %r failed (status %s) '
+                     '- checking names individually instead: %r',
+                     preferred_name, self.ckanclient.last_status, e.args)
+            return set()
+        return pkg_names.intersection(candidates)
+
+    def _claim_pkg_name(self, pkg_name):
+        '''Records that a new package is going to take this name, so that
+        no other package created in this run will try to.
+        @return False if it has already been claimed
+        '''
+        with self._lock:
+            if pkg_name in self._claimed_pkg_names:
+                return False
+            self._claimed_pkg_names.add(pkg_name)
+            return True
+
+    def _release_pkg_name(self, pkg_name):
+        '''Undoes _claim_pkg_name, when the package was not created.'''
+        with self._lock:
+            self._claimed_pkg_names.discard(pkg_name)
+
+    def _pkg_fingerprint(self, pkg_dict):
+        '''Returns a hash of the content of the pkg_dict, which is stable
+        between runs. Blank values and the keys that _pkg_has_changed
+        ignores do not affect it.'''
+        content = json.dumps(self._normalise_for_fingerprint(pkg_dict),
+                             sort_keys=True, default=unicode)
+        return hashlib.sha1(content).hexdigest()
+
+    def _normalise_for_fingerprint(self, value):
+        if isinstance(value, dict):
+            ignore_keys = self._keys_to_ignore_when_comparing() + \
+                          (self.fingerprint_extra_key,)
+            return dict((key, self._normalise_for_fingerprint(sub_value))
+                        for key, sub_value in value.items()
+                        if key not in ignore_keys and sub_value)
+        elif isinstance(value, (list, tuple)):
+            return [self._normalise_for_fingerprint(sub_value)
+                    for sub_value in value]
+        return value or None
+
+    def _find_package_by_fingerprint(self, pkg_name, pkg, fingerprint):
+        '''Checks if the existing package was last written with a pkg_dict
+        with this fingerprint, going by the package dict (if it has been
+        got) or else the index.
+        @return the package if the fingerprint matches, otherwise None
+        '''
+        if not pkg and self._index is not None:
+            index_entry = self._index.get(pkg_name)
+            if not index_entry or index_entry['fingerprint'] != fingerprint:
+                return None
+            # the package is returned, so get it (if it is not cached),
+            # which also confirms the index is right
+            pkg = self._get_package(pkg_name)
+        if pkg and (pkg.get('extras') or {}).get(self.fingerprint_extra_key) \
+               == fingerprint:
+            return pkg
+        return None
+
+    def _keys_to_ignore_when_comparing(self):
+        # owner_org - loader doesn't setup groups
+        # import_source - changing alone doesn't require an update
+        return ('owner_org', 'import_source')
+
     def _pkg_has_changed(self, existing_value, value):
         changed = False
         if isinstance(value, dict):
             for key, sub_value in value.items():
-                if key in ('owner_org', 'import_source'):
-                    # loader doesn't setup groups
-                    # import_source changing alone doesn't require an update
+                if key in self._keys_to_ignore_when_comparing():
                     continue
                 existing_sub_value = existing_value.get(key)
                 if self._pkg_has_changed(existing_sub_value, sub_value):
@@ -382,16 +1321,69 @@ class ReplaceByNameLoader(PackageLoader):
 
 class ReplaceByExtraFieldLoader(PackageLoader):
     '''Loader finds a package based on a unique id in an extra field.
-    Loader replaces the package with the supplied pkg_dict.'''
-    def __init__(self, ckanclient, package_id_extra_key, stats=None):
-        super(ReplaceByExtraFieldLoader, self).__init__(ckanclient, stats)
+    Loader replaces the package with the supplied pkg_dict.
+
+    Call build_index() before loading to find packages in an in-memory
+    index of the CKAN server's packages, rather than searching for each.
+    '''
+    def __init__(self, ckanclient, package_id_extra_key, stats=None,
+                 **kwargs):
+        super(ReplaceByExtraFieldLoader, self).__init__(ckanclient, stats,
+                                                        **kwargs)
         assert package_id_extra_key
         self.package_id_extra_key = package_id_extra_key
+        self._index_by_extra = {} # normalised extra value: [pkg_name, ...]
+        self._extra_values_by_name = {}
+
+    def _identity_field_keys(self):
+        return [self.package_id_extra_key]
 
     def _find_package(self, pkg_dict):
         find_pkg_by_keys = [self.package_id_extra_key]
+        if self._index is not None:
+            return self._find_package_in_index(find_pkg_by_keys, pkg_dict)
         return self._find_package_by_fields(find_pkg_by_keys, pkg_dict)
 
+    def _find_package_in_index(self, field_keys, pkg_dict):
+        '''Equivalent of _find_package_by_fields, using the index.'''
+        search_options = self._get_search_options(field_keys, pkg_dict)
+        value = self.lower(search_options[self.package_id_extra_key])
+        with self._lock:
+            pkg_names = list(self._index_by_extra.get(value, []))
+        if len(pkg_names) > 1:
+            log.error('More than one record matches the search options %r: %r (so picking the first one)' % (search_options, pkg_names))
+        if pkg_names:
+            pkg_name, pkg = pkg_names[0], None
+        else:
+            # The index is built from the search index, so just in case
+            # that is not up to date, look for the package under its name
+            pkg_name, pkg = self._find_package_by_name_probing(pkg_dict,
+                                                               search_options)
+        log.info('..Index lookup for existing package found: %r with '
+                 'filter: %r', pkg_name, search_options)
+        return pkg_name, pkg
+
+    def build_index(self, page_size=1000):
+        self._index_by_extra = {}
+        self._extra_values_by_name = {}
+        super(ReplaceByExtraFieldLoader, self).build_index(page_size)
+
+    def _index_package(self, pkg):
+        super(ReplaceByExtraFieldLoader, self)._index_package(pkg)
+        if pkg.get('state', ACTIVE) != ACTIVE:
+            return
+        value = self.lower((pkg.get('extras') or {}).get(
+            self.package_id_extra_key))
+        with self._lock:
+            # remove any entry for the package's previous value
+            previous_value = self._extra_values_by_name.get(pkg['name'])
+            if previous_value in self._index_by_extra:
+                self._index_by_extra[previous_value].remove(pkg['name'])
+            self._extra_values_by_name[pkg['name']] = value
+            if value:
+                pkg_names = self._index_by_extra.setdefault(value, [])
+                pkg_names.append(pkg['name'])
+
 class ResourceSeriesLoader(PackageLoader):
     '''Loader finds package based on a specified field and checks to see
     if most fields (listed in field_keys_to_expect_invariant) match the
@@ -407,14 +1399,21 @@ class ResourceSeriesLoader(PackageLoader):
                       means resources for the department DfE would be inserted
                       into a package which still had the old deparment name
                       of DCSF (and the same for CLG and GCLG).
+    @param coalesce - in load_packages, group the pkg_dicts by the package
+                      they are for, merge each group's resources in memory
+                      and write each package once, rather than once per
+                      pkg_dict. All the pkg_dicts are read first.
     '''
     def __init__(self, ckanclient,
                  field_keys_to_find_pkg_by,
                  field_keys_to_expect_invariant=None,
                  synonyms=None,
                  extras_to_not_overwrite=None,
-                 stats=None):
-        super(ResourceSeriesLoader, self).__init__(ckanclient, stats=stats)
+                 stats=None,
+                 coalesce=False,
+                 **kwargs):
+        super(ResourceSeriesLoader, self).__init__(ckanclient, stats=stats,
+                                                   **kwargs)
         assert field_keys_to_find_pkg_by
         assert isinstance(field_keys_to_find_pkg_by, (list, tuple))
         self.field_keys_to_find_pkg_by = field_keys_to_find_pkg_by
@@ -422,6 +1421,93 @@ class ResourceSeriesLoader(PackageLoader):
                                               or []
         self.synonyms = synonyms or {}
         self.extras_to_not_overwrite = extras_to_not_overwrite or []
+        self.coalesce = coalesce
+        # whether the server has shown it understands combined searches
+        # (None means it is not yet known)
+        self._combined_search_works = None
+
+    def _keys_to_ignore_when_comparing(self):
+        # Several pkg_dicts are merged into each package, so the stored
+        # fingerprint is of the last one merged. Changing it alone would
+        # mean rewriting the package for each of them on every run.
+        return super(ResourceSeriesLoader, self)._keys_to_ignore_when_comparing() + \
+               (self.fingerprint_extra_key,)
+
+    def _identity_field_keys(self):
+        return self.field_keys_to_find_pkg_by
+
+    def _identity_search_options(self, pkg_dict):
+        # synonyms of a value are for the same package, so use the first
+        search_options = super(ResourceSeriesLoader, self)._identity_search_options(pkg_dict)
+        for field_key, field_value in search_options.items():
+            for synonym_list in self.synonyms.get(field_key, []):
+                if field_value in synonym_list:
+                    search_options[field_key] = synonym_list[0]
+                    break
+        return search_options
+
+    def _load_packages_outcomes(self, pkg_dicts, workers, ckanclient_factory,
+                                journal):
+        if not self.coalesce:
+            return super(ResourceSeriesLoader, self)._load_packages_outcomes(
+                pkg_dicts, workers, ckanclient_factory, journal)
+        groups = self._group_pkg_dicts(pkg_dicts)
+        group_outcomes = self._run_for_outcomes(
+            lambda group: self._load_package_outcome(group[1], journal),
+            groups, workers, ckanclient_factory)
+        outcomes = {}
+        for group_index, outcome in group_outcomes.items():
+            indexed_pkg_dicts = groups[group_index][0]
+            for index, pkg_dict in indexed_pkg_dicts:
+                outcomes[index] = outcome
+            if outcome[0] == 'loaded':
+                for index, pkg_dict in indexed_pkg_dicts[1:]:
+                    self._add_stat('Combined with another dataset', pkg_dict)
+                    self.metrics.count_outcome('combined')
+        return outcomes
+
+    def _group_pkg_dicts(self, pkg_dicts):
+        '''Groups the pkg_dicts by the package they are for, and merges
+        each group into one pkg_dict, as if they were loaded in turn.
+
+        @return [([(index, pkg_dict), ...], merged_pkg_dict), ...] in the
+                order each group first appears
+        '''
+        groups = []
+        group_index_by_identity = {}
+        for index, pkg_dict in enumerate(pkg_dicts):
+            try:
+                identity = self._pkg_identity(pkg_dict)
+            except LoaderError:
+                # loading it alone will report the error
+                identity = None
+            group_index = group_index_by_identity.get(identity)
+            if identity is None or group_index is None:
+                group_index_by_identity[identity] = len(groups)
+                groups.append([(index, pkg_dict)])
+            else:
+                groups[group_index].append((index, pkg_dict))
+
+        merged_groups = []
+        for group in groups:
+            merged_pkg_dict = group[0][1]
+            try:
+                for index, pkg_dict in group[1:]:
+                    merged_pkg_dict = self._merge_resources(merged_pkg_dict,
+                                                            pkg_dict)
+            except (KeyError, AttributeError), e:
+                log.warn('Could not merge pkg_dicts for %s, so loading them '
+                         'separately: %r', group[0][1].get('name'), e)
+                merged_groups.extend(([(index, pkg_dict)], pkg_dict)
+                                     for index, pkg_dict in group)
+                continue
+            if len(group) > 1:
+                # a new package gets the name the first pkg_dict asks for
+                merged_pkg_dict['name'] = group[0][1]['name']
+                log.info('Coalesced %i pkg_dicts for package %s',
+                         len(group), merged_pkg_dict['name'])
+            merged_groups.append((group, merged_pkg_dict))
+        return merged_groups
 
     def _find_package(self, pkg_dict):
         # take a copy of the keys since the find routine may change them
@@ -445,18 +1531,107 @@ class ResourceSeriesLoader(PackageLoader):
                                 search_options_list.append(alt_opts)
         return search_options_list
 
+    # Package fields which SOLR indexes under their own name. Extras are
+    # indexed as 'extras_<key>'.
+    solr_package_fields = ('name', 'title', 'notes', 'author', 'maintainer',
+                           'url', 'version', 'license_id', 'tags', 'groups',
+                           'state')
+
     def _package_search(self, search_options_list):
+        '''Searches for packages matching any of the search options.
+        Where there are several (due to synonyms), they are combined into
+        one SOLR query if the server supports it, else searched for one
+        by one. Each package is only returned once.'''
+        combined_res = None
+        if len(search_options_list) > 1 and \
+               self._combined_search_works is not False:
+            res = self._combined_package_search(search_options_list)
+            if res is not None and self._combined_search_works:
+                return {'count': res['count'],
+                        'results': self._unique_search_results(
+                            res['results'])}
+            # Until the combined search has found packages that the
+            # separate searches confirm, do those too - a server which
+            # does not understand the query (e.g. text search only) can
+            # return nothing, or the wrong packages.
+            combined_res = res
         try:
             result_count = 0
             result_generators = []
             for search_options in search_options_list:
-                res = self.ckanclient.package_search(q='', search_options=search_options)
+                res = self.ckanclient.package_search(
+                    q='', search_options=dict(search_options, all_fields=1))
                 result_count += res['count']
                 result_generators.append(res['results'])
+            results = self._unique_search_results(
+                itertools.chain(*result_generators))
+            if combined_res is not None:
+                results = list(results)
+                combined_results = list(self._unique_search_results(
+                    combined_res['results']))
         except CkanApiError, e:
             raise LoaderError('Search request failed (status %s): %r' % (self.ckanclient.last_status, e.args))
-        return {'count': result_count,
-                'results': itertools.chain(*result_generators)}
+        if combined_res is not None:
+            keys = set(map(self._search_result_key, results))
+            if keys != set(map(self._search_result_key, combined_results)):
+                log.warn('Combined search results differ from searching '
+                         'for each set of synonyms, so searching separately '
+                         'from now on')
+                self._combined_search_works = False
+            elif keys:
+                self._combined_search_works = True
+            # (if neither found anything, it is still not known)
+        return {'count': result_count, 'results': iter(results)}
+
+    def _combined_package_search(self, search_options_list):
+        '''Does a single search for packages matching any of the search
+        options, using a SOLR query with the alternative values for each
+        field ORed together. (The search_options_list is the product of
+        the alternative values, so this is equivalent.)
+        @return the search result, or None if the search failed
+        '''
+        values_by_field = OrderedDict()
+        for search_options in search_options_list:
+            for key, value in search_options.items():
+                values = values_by_field.setdefault(key, [])
+                if value not in values:
+                    values.append(value)
+        q = ' AND '.join(
+            '%s:(%s)' % (self._solr_field_name(key),
+                         ' OR '.join('"%s"' % solr_escape(value)
+                                     for value in values))
+            for key, values in values_by_field.items())
+        try:
+            res = self.ckanclient.package_search(
+                q=q, search_options={'all_fields': 1})
+        except CkanApiError, e:
+            status = self.ckanclient.last_status
+            log.warn('Combined search failed (status %s), so searching for '
+                     'each set of synonyms separately: %r', status, e.args)
+            if status == 400:
+                # the server does not understand the query (whereas other
+                # errors may be temporary)
+                self._combined_search_works = False
+            return None
+        return res
+
+    def _solr_field_name(self, key):
+        if key in self.solr_package_fields:
+            return key
+        return 'extras_%s' % key
+
+    def _search_result_key(self, result):
+        return result['name'] if isinstance(result, dict) else result
+
+    def _unique_search_results(self, results):
+        '''Filters out repeats of the same package from search results.'''
+        seen = set()
+        for result in results:
+            key = self._search_result_key(result)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield result
 
     def _pkg_matches_search_options(self, pkg_dict, search_options_list):
         '''Returns True if pkg_dict matches any of the search_options
@@ -468,20 +1643,20 @@ class ResourceSeriesLoader(PackageLoader):
                 break
         return matches
 
-    def _write_package(self, pkg_dict, existing_pkg_name, existing_pkg=None):
+    def _prepare_write(self, pkg_dict, existing_pkg_name, existing_pkg=None):
         '''
-        Writes a package (pkg_dict). If there is an existing package to
-        be changed, then supply existing_pkg_name. If the caller has already
-        got the existing package then pass it in, to save getting it twice.
+        Works out how to write a package (pkg_dict), merging its resources
+        into the existing package.
 
-        May raise LoaderError or CkanApiNotAuthorizedError (which implies API
-        key is wrong, so stop).
+        @return operation - see PackageLoader._prepare_write
         '''
         if existing_pkg_name:
             if not existing_pkg:
-                existing_pkg = self._get_package(existing_pkg_name)
+                with self.metrics.phase('get'):
+                    existing_pkg = self._get_package(existing_pkg_name)
             try:
-                pkg_dict = self._merge_resources(existing_pkg, pkg_dict)
+                with self.metrics.phase('merge'):
+                    pkg_dict = self._merge_resources(existing_pkg, pkg_dict)
             except Exception, e:
                 raise LoaderError('Could not merge resources.\n'
                                   '  existing_pkg: %r\n'
@@ -492,16 +1667,17 @@ class ResourceSeriesLoader(PackageLoader):
                 if existing_pkg and existing_pkg['extras'].get('theme-primary'):
                     pkg_dict['extras']['theme-primary'] = existing_pkg['extras']['theme-primary']
                     pkg_dict['extras']['themes-secondary'] = existing_pkg['extras'].get('themes-secondary')
-        super(ResourceSeriesLoader, self)._write_package(pkg_dict,
-                                                        existing_pkg_name,
-                                                        existing_pkg)
+        return super(ResourceSeriesLoader, self)._prepare_write(
+            pkg_dict, existing_pkg_name, existing_pkg)
 
     def _merge_resources(self, existing_pkg, pkg):
         '''Takes an existing_pkg and merges in resources from the pkg.
         '''
         log.info("..Merging resources into %s" % existing_pkg["name"])
-        log.debug("....Existing resources:\n%s" % pformat(existing_pkg["resources"]))
-        log.debug("....New resources:\n%s" % pformat(pkg["resources"]))
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug("....Existing resources:\n%s" % pformat(existing_pkg["resources"]))
+            log.debug("....New resources:\n%s" % pformat(pkg["resources"]))
 
         # check invariant fields aren't different
         warnings = []
@@ -518,25 +1694,32 @@ class ResourceSeriesLoader(PackageLoader):
                      'changes in these values:\n%s' % (existing_pkg['name'], 
                                                        '; '.join(warnings)))
 
-        # copy over all fields but use the existing resources
+        # copy over all fields but use the existing resources. (The
+        # resource dicts themselves are shared, since they are not changed -
+        # ones being edited are replaced.)
         merged_dict = pkg.copy()
-        merged_dict['resources'] = copy.deepcopy(existing_pkg['resources'])
+        merged_dict['resources'] = list(existing_pkg['resources'])
+
+        # index the position of each resource ID (the first, if repeated)
+        res_positions = {}
+        for i, existing_res in enumerate(merged_dict['resources']):
+            res_positions.setdefault(self._get_resource_id(existing_res), i)
 
         # merge resources
         for pkg_res in pkg['resources']:
             # look for resource ID already being there
             pkg_res_id = self._get_resource_id(pkg_res)
-            for i, existing_res in enumerate(merged_dict['resources']):
-                res_id = self._get_resource_id(existing_res)
-                if res_id == pkg_res_id:
-                    # edit existing resource
-                    merged_dict['resources'][i] = pkg_res
-                    break
+            i = res_positions.get(pkg_res_id)
+            if i is not None:
+                # edit existing resource
+                merged_dict['resources'][i] = pkg_res
             else:
                 # insert new res
+                res_positions[pkg_res_id] = len(merged_dict['resources'])
                 merged_dict['resources'].append(pkg_res)
 
-        log.debug("....Merged resources:\n%s" % pformat(merged_dict["resources"]))
+        if debug:
+            log.debug("....Merged resources:\n%s" % pformat(merged_dict["resources"]))
 
         return merged_dict
 
@@ -0,0 +1,378 @@
+'''
+Metrics of loading packages: timings of the phases of loading (finding the
+existing package, choosing a name, comparing, merging, writing etc.), the
+API calls made in each, and counts of the packages created, updated etc.
+and of the errors. They are aggregated as they are recorded, in fixed
+memory, so they are cheap enough to leave on.
+
+After a run:
+
+    print loader.metrics.report()
+    loader.metrics.summary()['find']['p95']
+
+They can be exported as JSON and in the Prometheus textfile format (for
+node_exporter's textfile collector), at the end of a run and periodically
+during it:
+
+    with MetricsExporter(loader.metrics, prometheus_path='loader.prom',
+                         json_path='loader.json', interval=60):
+        loader.load_packages(pkg_dicts)
+'''
+import os
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from scheduler import IDEMPOTENT_METHODS, WRITE_METHODS
+
+log = __import__("logging").getLogger(__name__)
+
+# Upper bounds (seconds) of the histogram buckets - each about 19% bigger
+# than the last, from 0.1ms to about 100s. (There is one more bucket, for
+# larger values.)
+BUCKET_BOUNDS = tuple(0.0001 * 2 ** (i / 4.0) for i in range(81))
+
+class Histogram(object):
+    '''Aggregates durations (or other values), so that the count, total and
+    percentiles can be given. Percentiles are accurate to the bucket size
+    (about 19%). Not thread-safe - the caller must lock.'''
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        '''Returns the value which percent% of the values are no more than
+        (rounded up to a bucket bound), or None if there are no values.'''
+        if not self.count:
+            return None
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        cumulative = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                if i == len(self.bounds):
+                    return self.max
+                return max(self.min, min(self.max, self.bounds[i]))
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class LoaderMetrics(object):
+    '''Timings of the phases of loading, and the API calls made in each.
+    Thread-safe. Phases may be nested, in which case an API call counts
+    for the innermost phase.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.start_time = time.time()
+        self.histograms = {} # phase: Histogram
+        self.api_calls = {} # phase: {method_name: count}
+        self.outcomes = {} # 'created'/'updated'/'unchanged' etc: count
+        self.errors = {} # exception class name: count
+        self.cache_lookups = {} # 'hit'/'miss': count, of the package cache
+
+    @contextmanager
+    def phase(self, name):
+        '''Times the code in the with block as the named phase.'''
+        phases = self._phases()
+        phases.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            phases.pop()
+            with self._lock:
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.add(duration)
+
+    def _phases(self):
+        try:
+            return self._local.phases
+        except AttributeError:
+            self._local.phases = []
+            return self._local.phases
+
+    def current_phase(self):
+        phases = self._phases()
+        return phases[-1] if phases else None
+
+    def count_api_call(self, method_name):
+        phase = self.current_phase()
+        with self._lock:
+            calls = self.api_calls.setdefault(phase, {})
+            calls[method_name] = calls.get(method_name, 0) + 1
+
+    def count_outcome(self, outcome):
+        '''Counts a package dealt with, by its outcome e.g. 'created',
+        'updated', 'unchanged'.'''
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def count_error(self, exception):
+        '''Counts a package which failed to load, by the exception's
+        class.'''
+        error = exception.__class__.__name__
+        with self._lock:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def count_cache_lookup(self, hit):
+        '''Counts a lookup in the package cache.'''
+        result = 'hit' if hit else 'miss'
+        with self._lock:
+            self.cache_lookups[result] = self.cache_lookups.get(result, 0) + 1
+
+    def packages_per_second(self):
+        '''The rate packages have been dealt with (including errors) since
+        this LoaderMetrics was created.'''
+        with self._lock:
+            num_packages = sum(self.outcomes.values()) + \
+                           sum(self.errors.values())
+        elapsed = time.time() - self.start_time
+        return num_packages / elapsed if elapsed > 0 else 0.0
+
+    def wrap(self, ckanclient):
+        '''Returns a proxy for the ckanclient which counts its API calls
+        against the current phase.'''
+        return MeteredCkanClient(ckanclient, self)
+
+    def summary(self):
+        '''@return {phase: {'count':..., 'total':..., 'p50':..., 'p95':...,
+                            'p99':..., 'api_calls': {method_name: count}}}
+                   (API calls made outside any phase are under None)
+        '''
+        with self._lock:
+            summary = dict((phase, histogram.as_dict())
+                           for phase, histogram in self.histograms.items())
+            for phase, calls in self.api_calls.items():
+                summary.setdefault(phase, {})['api_calls'] = dict(calls)
+        for phase_summary in summary.values():
+            phase_summary.setdefault('api_calls', {})
+        return summary
+
+    def as_dict(self):
+        '''@return all the metrics, as JSON-serialisable values'''
+        with self._lock:
+            outcomes = dict(self.outcomes)
+            errors = dict(self.errors)
+            cache_lookups = dict(self.cache_lookups)
+        return {'time': time.time(),
+                'start_time': self.start_time,
+                'packages_per_second': self.packages_per_second(),
+                'outcomes': outcomes,
+                'errors': errors,
+                'cache_lookups': cache_lookups,
+                'phases': dict((phase or 'other', values) for phase, values
+                               in self.summary().items())}
+
+    def export_json(self, filepath):
+        write_atomically(filepath, json.dumps(self.as_dict(), indent=2,
+                                              sort_keys=True))
+
+    def export_prometheus(self, filepath, prefix='ckan_loader'):
+        write_atomically(filepath, self.as_prometheus_text(prefix))
+
+    def as_prometheus_text(self, prefix='ckan_loader'):
+        '''@return the metrics in the Prometheus text exposition format'''
+        lines = []
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, escape_label(label))
+                                      for key, label in labels)
+                lines.append('%s_%s%s%s %s' % (
+                    prefix, name, suffix,
+                    '{%s}' % label_text if label_text else '',
+                    format_value(value)))
+
+        with self._lock:
+            outcomes = sorted(self.outcomes.items())
+            errors = sorted(self.errors.items())
+            cache_lookups = sorted(self.cache_lookups.items())
+            api_calls = sorted((phase or 'other', method_name, num)
+                               for phase, calls in self.api_calls.items()
+                               for method_name, num in calls.items())
+            histograms = sorted((phase, histogram.bounds,
+                                 list(histogram.bucket_counts),
+                                 histogram.total, histogram.count)
+                                for phase, histogram
+                                in self.histograms.items())
+        metric('packages_total', 'counter', 'Packages loaded, by outcome',
+               [('', [('outcome', outcome)], num)
+                for outcome, num in outcomes])
+        metric('errors_total', 'counter',
+               'Packages which failed to load, by error',
+               [('', [('error', error)], num) for error, num in errors])
+        metric('package_cache_lookups_total', 'counter',
+               'Lookups in the package cache, by result',
+               [('', [('result', result)], num)
+                for result, num in cache_lookups])
+        metric('api_calls_total', 'counter',
+               'CKAN API calls, by phase and method',
+               [('', [('phase', phase), ('method', method_name)], num)
+                for phase, method_name, num in api_calls])
+        samples = []
+        for phase, bounds, bucket_counts, total, count in histograms:
+            # export every 4th bucket bound (doubling), to keep it short
+            cumulative = 0
+            for i, bucket_count in enumerate(bucket_counts[:len(bounds)]):
+                cumulative += bucket_count
+                if i % 4 == 0:
+                    samples.append(('_bucket', [('phase', phase),
+                                                ('le', format_value(bounds[i]))],
+                                    cumulative))
+            samples.append(('_bucket', [('phase', phase), ('le', '+Inf')],
+                            count))
+            samples.append(('_sum', [('phase', phase)], total))
+            samples.append(('_count', [('phase', phase)], count))
+        metric('phase_duration_seconds', 'histogram',
+               'Time taken by each phase of loading packages', samples)
+        metric('packages_per_second', 'gauge',
+               'Packages dealt with per second, since the run started',
+               [('', [], self.packages_per_second())])
+        metric('start_time_seconds', 'gauge',
+               'When the run started, as a Unix time',
+               [('', [], self.start_time)])
+        metric('export_time_seconds', 'gauge',
+               'When these metrics were exported, as a Unix time',
+               [('', [], time.time())])
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        '''@return the summary as a table, for logs'''
+        lines = ['%-14s %7s %9s %9s %9s %9s  %s' % (
+            'phase', 'count', 'total/s', 'p50/ms', 'p95/ms', 'p99/ms',
+            'API calls')]
+        def ms(value):
+            return '%9.1f' % (value * 1000) if value is not None else ' ' * 9
+        for phase, values in sorted(self.summary().items()):
+            calls = ', '.join('%s %i' % (method_name, num) for
+                              method_name, num in
+                              sorted(values['api_calls'].items()))
+            lines.append('%-14s %7s %9s %s %s %s  %s' % (
+                phase or '(other)', values.get('count', ''),
+                '%.3f' % values['total'] if 'total' in values else '',
+                ms(values.get('p50')), ms(values.get('p95')),
+                ms(values.get('p99')), calls))
+        with self._lock:
+            cache_lookups = dict(self.cache_lookups)
+        if cache_lookups:
+            lines.append('Package cache: %i hits, %i misses' % (
+                cache_lookups.get('hit', 0), cache_lookups.get('miss', 0)))
+        return '\n'.join(lines)
+
+
+class MeteredCkanClient(object):
+    '''Proxy for a ckanclient, which counts the calls of its methods. Other
+    attributes (last_status, last_message etc.) are those of the
+    ckanclient.'''
+    def __init__(self, ckanclient, metrics):
+        self._ckanclient = ckanclient
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._ckanclient, name)
+        if name not in IDEMPOTENT_METHODS and name not in WRITE_METHODS:
+            return attr
+        def metered_method(*args, **kwargs):
+            self._metrics.count_api_call(
+                args[0] if name == 'action' and args else name)
+            return attr(*args, **kwargs)
+        return metered_method
+
+
+class MetricsExporter(object):
+    '''Exports a LoaderMetrics to files periodically, from a background
+    thread, and once more when stopped. Use it as a context manager, or call
+    start() and stop().
+    @param json_path, prometheus_path - files to write (either may be None)
+    @param interval - seconds between exports
+    '''
+    def __init__(self, metrics, json_path=None, prometheus_path=None,
+                 interval=60, prefix='ckan_loader'):
+        assert json_path or prometheus_path
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.prefix = prefix
+        self._stop = threading.Event()
+        self._thread = None
+
+    def export(self):
+        if self.json_path:
+            self.metrics.export_json(self.json_path)
+        if self.prometheus_path:
+            self.metrics.export_prometheus(self.prometheus_path, self.prefix)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='metrics-exporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except Exception, e:
+                log.error('Could not export metrics: %r', e)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def write_atomically(filepath, content):
+    '''Writes the file so that readers never see it partly written.'''
+    tmp_filepath = '%s.%i.tmp' % (filepath, os.getpid())
+    with open(tmp_filepath, 'w') as f:
+        f.write(content)
+    os.rename(tmp_filepath, filepath)
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"')\
+           .replace('\n', '\\n').encode('utf8')
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,211 @@
+'''
+Client-side pacing of the API requests made with a ckanclient, so that a
+loader settles at the rate the CKAN server can sustain, rather than
+overloading it.
+
+A RequestScheduler combines:
+ * a token bucket, limiting the request rate
+ * a limit on the number of requests in flight (across all the threads
+   sharing the scheduler), adjusted AIMD-style: it grows slowly while
+   requests succeed, and halves when the server says it is overloaded
+   (429/503) or responses are slower than a target latency
+ * retries with jittered exponential backoff, for requests that are safe
+   to repeat (GETs and searches)
+
+Wrap each ckanclient with the scheduler, e.g.:
+
+    scheduler = RequestScheduler(rate=10, max_in_flight=8)
+    loader = ReplaceByNameLoader(ckanclient, scheduler=scheduler)
+'''
+import time
+import random
+import threading
+
+from ckanclient import CkanApiError
+try:
+    from ckanclient import CkanApiActionError
+except ImportError:
+    # older ckanclient, without the Action API
+    CkanApiActionError = CkanApiError
+
+log = __import__("logging").getLogger(__name__)
+
+# ckanclient methods that only read, so are safe to retry
+IDEMPOTENT_METHODS = set(('api_version_get',
+                          'package_register_get', 'package_entity_get',
+                          'package_relationship_register_get',
+                          'tag_register_get', 'tag_entity_get',
+                          'group_register_get', 'group_entity_get',
+                          'package_search', 'package_list', 'package_show'))
+# ckanclient methods that make requests, but which may change things
+WRITE_METHODS = set(('package_register_post', 'package_entity_put',
+                     'package_entity_delete',
+                     'package_relationship_entity_post',
+                     'package_relationship_entity_put',
+                     'package_relationship_entity_delete',
+                     'group_register_post', 'group_entity_put',
+                     'action'))
+
+OVERLOADED_STATUSES = (429, 503)
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+class RequestScheduler(object):
+    def __init__(self, rate=None, burst=None,
+                 max_in_flight=16, min_in_flight=1, initial_in_flight=None,
+                 target_latency=None,
+                 max_retries=3, backoff=0.5, max_backoff=30.0):
+        '''
+        @param rate - maximum requests per second (None for no limit)
+        @param burst - number of requests that can be made at once before
+                       the rate applies (default: rate, or 1 if less)
+        @param max_in_flight/min_in_flight - bounds of the number of
+                       requests allowed in flight at once
+        @param initial_in_flight - the limit to start at (default:
+                       max_in_flight)
+        @param target_latency - seconds. A response slower than this is
+                       treated as a sign of overload.
+        @param max_retries - the number of times to retry an idempotent
+                       request that fails with a retryable status
+        @param backoff - seconds to wait before the first retry. This
+                       doubles for each further retry (up to max_backoff),
+                       and the actual wait is a random fraction of it.
+        '''
+        assert min_in_flight >= 1
+        assert max_in_flight >= min_in_flight
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.in_flight_limit = float(initial_in_flight or max_in_flight)
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.num_requests = 0
+        self.num_retries = 0
+        self.num_overloads = 0
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._last_refill = time.time()
+        self._condition = threading.Condition()
+
+    def wrap(self, ckanclient):
+        '''Returns a proxy for the ckanclient which sends its requests
+        through this scheduler.'''
+        return ScheduledCkanClient(ckanclient, self)
+
+    def call(self, ckanclient, method_name, *args, **kwargs):
+        '''Calls the ckanclient method, pacing it and retrying it if it is
+        idempotent and fails with a retryable status.'''
+        method = getattr(ckanclient, method_name)
+        attempt = 0
+        while True:
+            try:
+                return self._call_once(ckanclient, method, *args, **kwargs)
+            except CkanApiError:
+                status = ckanclient.last_status
+                if method_name in IDEMPOTENT_METHODS and \
+                       attempt < self.max_retries and \
+                       self._is_retryable(status):
+                    attempt += 1
+                    self._wait_before_retry(method_name, status, attempt)
+                    continue
+                raise
+
+    def _call_once(self, ckanclient, method, *args, **kwargs):
+        '''Calls the method in a slot, which is released however the call
+        ends.'''
+        self._acquire()
+        start = time.time()
+        overloaded = False
+        try:
+            try:
+                result = method(*args, **kwargs)
+            except (CkanApiError, CkanApiActionError):
+                # the server responded, and its status says if it is
+                # overloaded. (Other exceptions, e.g. socket errors, are
+                # not taken as a sign of overload.)
+                overloaded = ckanclient.last_status in OVERLOADED_STATUSES
+                raise
+            latency = time.time() - start
+            overloaded = bool(self.target_latency and
+                              latency > self.target_latency)
+            return result
+        finally:
+            self._release(time.time() - start, overloaded)
+
+    def _is_retryable(self, status):
+        # ckanclient gives a connection failure the errno as its status
+        # (or None)
+        return status in RETRYABLE_STATUSES or \
+               not isinstance(status, int) or status < 100
+
+    def _wait_before_retry(self, method_name, status, attempt):
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** (attempt - 1)))
+        log.warn('Request %s failed (status %s) - retry %i in %.1fs',
+                 method_name, status, attempt, delay)
+        with self._condition:
+            self.num_retries += 1
+        time.sleep(delay)
+
+    def _acquire(self):
+        '''Waits for a slot for a request in flight, and a token.'''
+        with self._condition:
+            while self._in_flight >= int(self.in_flight_limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self.num_requests += 1
+        if self.rate:
+            self._take_token()
+
+    def _take_token(self):
+        while True:
+            with self._condition:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _release(self, latency, overloaded):
+        '''Frees the request's slot and adjusts the in-flight limit.'''
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                self.num_overloads += 1
+                self.in_flight_limit = max(self.min_in_flight,
+                                           self.in_flight_limit / 2)
+                log.info('Server overloaded (latency %.1fs) - requests in '
+                         'flight limited to %i', latency,
+                         int(self.in_flight_limit))
+            else:
+                # roughly +1 per limit's worth of successful requests
+                self.in_flight_limit = min(self.max_in_flight,
+                                           self.in_flight_limit +
+                                           1.0 / self.in_flight_limit)
+            self._condition.notify_all()
+
+
+class ScheduledCkanClient(object):
+    '''Proxy for a ckanclient, which sends requests through a
+    RequestScheduler. Other attributes (last_status, last_message etc.)
+    are those of the ckanclient.'''
+    def __init__(self, ckanclient, scheduler):
+        self._ckanclient = ckanclient
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        if name in IDEMPOTENT_METHODS or name in WRITE_METHODS:
+            # check the ckanclient has it
+            getattr(self._ckanclient, name)
+            def scheduled_method(*args, **kwargs):
+                return self._scheduler.call(self._ckanclient, name,
+                                            *args, **kwargs)
+            return scheduled_method
+        return getattr(self._ckanclient, name)
@@ -1,5 +1,13 @@
+import os
 import csv
 import copy
+import gzip
+import zipfile
+import posixpath
+import itertools
+import collections
+import cStringIO
+from xml.etree.cElementTree import iterparse
 
 from sqlalchemy.util import OrderedDict
 
@@ -23,68 +31,186 @@ class SpreadsheetData(object):
         self._logger = logger
         self._rows = []
 
-    def get_row(self, row_index):
-        'Returns a list of the cells in unicode format.'
+    def get_row(self, row_index, columns=None):
+        '''Returns a list of the cells in unicode format.
+        @param columns - if given, a list of the column indexes to return
+                         (and the other cells are not read)
+        '''
         raise NotImplementedError
 
     def get_num_rows(self):
         'Returns the number of rows in the sheet.'
         raise NotImplementedError
 
+    def release(self):
+        '''Frees memory held for the data, which is read again if it is
+        needed again.'''
+        pass
+
     def get_all_rows(self):
         'A crude way to get all the rows at once.'
-        return [self.get_row(i) for i in range(self.get_num_rows())]
+        return list(self.iter_rows())
+
+    def iter_rows(self, start=0, columns=None):
+        '''Yields the rows in turn, from row index start onwards.
+        @param columns - as for get_row
+        '''
+        for row_index in xrange(start, self.get_num_rows()):
+            if columns is None:
+                yield self.get_row(row_index)
+            else:
+                yield self.get_row(row_index, columns)
 
 
 class CsvData(SpreadsheetData):
+    '''Spreadsheet data in CSV format. The rows are read from the file
+    (or buf) as they are needed, rather than all held in memory. The first
+    look_ahead rows are kept (decoded), for finding the titles and first
+    record. Other rows are decoded as they are read, and only the columns
+    asked for, and the last row_cache_size rows got are kept. Gzipped CSV
+    is decompressed as it is read.
+    '''
+    look_ahead = 100
+    row_cache_size = 1000
+
     def __init__(self, logger, filepath=None, buf=None):
         super(CsvData, self).__init__(logger, filepath, buf)
-        if 1:
-            if filepath:
-                csvfile = open(filepath)
-                if not csvfile:
-                    raise ImportException('Could not open file \'%s\'.' % filepath)
-                csv_snippet = csvfile.read(1024)
-            elif buf:
-                csvfile = buf.split('\n')
-                if not csvfile:
-                    raise ImportException('Empty csv data.')
-                csv_snippet = buf[:1024]
-            try:
-                dialect = csv.Sniffer().sniff(csv_snippet)
-                dialect.doublequote = True # sniff doesn't seem to pick this up
-            except csv.Error, inst:
-                dialect = None
-            if filepath:
-                csvfile.seek(0)
+        self._filepath = filepath
+        self._buf = buf
+        self._compressed = False
+        csvfile = self._open()
+        try:
+            self._compressed = csvfile.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        finally:
+            csvfile.close()
+        csvfile = self._open()
+        try:
+            csv_snippet = csvfile.read(1024)
+        finally:
+            csvfile.close()
+        try:
+            self._dialect = csv.Sniffer().sniff(csv_snippet)
+            self._dialect.doublequote = True # sniff doesn't seem to pick this up
+        except csv.Error, inst:
+            self._dialect = None
+
+        # the number of rows is only counted if asked for
+        self._num_rows = None
+        # rows got with get_row: (row_index, columns): decoded row, least
+        # recently used first
+        self._row_cache = collections.OrderedDict()
+        # where get_row last read up to: [next row_index, rows], so that
+        # reading on from there does not read from the start again
+        self._cursor = None
+        self._head = [self._decode(row) for row in
+                      itertools.islice(self._read_rows(), self.look_ahead)]
+        if len(self._head) < self.look_ahead:
+            self._num_rows = len(self._head)
+        if len(self._head) < 2:
+            raise ImportException('Not enough rows')
+
+    def _read_rows(self):
+        '''Yields the rows (undecoded), reading from the start of the
+        file.'''
+        csvfile = self._open()
+        try:
             try:
-                reader = csv.reader(csvfile, dialect)
+                reader = csv.reader(csvfile, self._dialect)
             except TypeError, inst:
                 raise ImportException('CSV file read error: %s' % inst)
+            try:
+                for row in reader:
+                    yield row
+            except csv.Error, inst:
+                raise ImportException('CSV file corrupt: %s' % inst)
+        finally:
+            csvfile.close()
+
+    def _open(self):
+        if self._filepath:
+            if self._compressed:
+                return gzip.open(self._filepath, 'rb')
+            return open(self._filepath, 'rb')
+        if self._compressed:
+            return gzip.GzipFile(fileobj=cStringIO.StringIO(self._buf))
+        return cStringIO.StringIO(self._buf)
 
-        try:
-            for line in reader:
-                self._rows.append(line)
-        except csv.Error, inst:
-            raise ImportException('CSV file corrupt: %s' % inst)
-        self._num_rows = len(self._rows)
-        if self._num_rows < 2:
-            raise ImportException('Not enough rows')
-            
     def get_num_sheets(self):
         return 1
 
-    def get_row(self, row_index):
-        row = self._rows[row_index]
-        return [cell.decode('utf8') for cell in row]
+    def _decode(self, row, columns=None):
+        if columns is None:
+            return [cell.decode('utf8') for cell in row]
+        # (a short row is blank in the missing columns)
+        return [row[i].decode('utf8') if i < len(row) else u''
+                for i in columns]
+
+    def _project(self, decoded_row, columns):
+        if columns is None:
+            return list(decoded_row)
+        return [decoded_row[i] if i < len(decoded_row) else u''
+                for i in columns]
+
+    def get_row(self, row_index, columns=None):
+        if row_index < len(self._head):
+            return self._project(self._head[row_index], columns)
+        key = (row_index, tuple(columns) if columns is not None else None)
+        decoded_row = self._row_cache.pop(key, None)
+        if decoded_row is None:
+            decoded_row = self._decode(self._read_row(row_index), columns)
+        self._row_cache[key] = decoded_row
+        while len(self._row_cache) > self.row_cache_size:
+            self._row_cache.popitem(last=False)
+        return list(decoded_row)
+
+    def _read_row(self, row_index):
+        '''Returns the row (undecoded), reading on from the last row read
+        if possible.'''
+        if self._cursor is None or self._cursor[0] > row_index:
+            self._close_cursor()
+            self._cursor = [0, self._read_rows()]
+        next_row_index, rows = self._cursor
+        try:
+            row = itertools.islice(rows, row_index - next_row_index,
+                                   None).next()
+        except StopIteration:
+            self._close_cursor()
+            raise IndexError('Row index out of range: %i' % row_index)
+        self._cursor[0] = row_index + 1
+        return row
+
+    def _close_cursor(self):
+        if self._cursor is not None:
+            self._cursor[1].close()
+            self._cursor = None
+
+    def release(self):
+        self._row_cache = collections.OrderedDict()
+        self._close_cursor()
 
     def get_num_rows(self):
+        if self._num_rows is None:
+            self._num_rows = sum(1 for row in self._read_rows())
         return self._num_rows
 
+    def iter_rows(self, start=0, columns=None):
+        for decoded_row in self._head[start:]:
+            yield self._project(decoded_row, columns)
+        if self._num_rows == len(self._head):
+            # all the rows are in the head
+            return
+        # stream the rest, skipping (but not decoding) the head's rows
+        for row in itertools.islice(self._read_rows(),
+                                    max(start, len(self._head)), None):
+            yield self._decode(row, columns)
+
 
 class XlData(SpreadsheetData):
     '''Spreadsheet data in Excel format.
     NB Cells with no value return None rather than u''.
+    Sheets are only parsed when they are first used. For a workbook with
+    several sheets, use get_data_by_sheet, which gives an XlData for each
+    sheet, all sharing the one opened workbook.
     @param sheet_index - if None, warn if more than 1 sheet in workbook.
     '''
     def __init__(self, logger, filepath=None, buf=None, sheet_index=None):
@@ -93,17 +219,30 @@ class XlData(SpreadsheetData):
 
         try:
             if filepath:
-                self._book = xlrd.open_workbook(filepath)
+                self._book = xlrd.open_workbook(filepath, on_demand=True)
             elif buf:
-                self._book = xlrd.open_workbook(file_contents=buf)
+                self._book = xlrd.open_workbook(file_contents=buf,
+                                                on_demand=True)
         except xlrd.XLRDError, e:
             raise ImportException('Could not open workbook: %r' % e)
 
         if sheet_index == None:
             if self.get_num_sheets() != 1:
-                logger.log.append('Warning: Just importing from sheet %r' % self._book.sheet_by_index(0).name)
+                logger.log.append('Warning: Just importing from sheet %r' % self.get_sheet_names()[0])
             sheet_index = 0
-        self.sheet = self._book.sheet_by_index(sheet_index)
+        self._sheet_index = sheet_index
+        self._sheet = None
+
+    @property
+    def sheet(self):
+        if self._sheet is None:
+            self._sheet = self._book.sheet_by_index(self._sheet_index)
+        return self._sheet
+
+    def release(self):
+        if self._sheet is not None:
+            self._sheet = None
+            self._book.unload_sheet(self._sheet_index)
 
     def get_num_sheets(self):
         return self._book.nsheets
@@ -114,14 +253,19 @@ class XlData(SpreadsheetData):
     def get_data_by_sheet(self):
         data_list = []
         for sheet_index in range(self.get_num_sheets()):
-            data = copy.deepcopy(self)
-            data.sheet = self._book.sheet_by_index(sheet_index)
+            # (shares the workbook)
+            data = copy.copy(self)
+            data._sheet_index = sheet_index
+            data._sheet = None
             data_list.append(data)
         return data_list
 
-    def get_row(self, row_index):
+    def get_row(self, row_index, columns=None):
         import xlrd
         row = self.sheet.row(row_index)
+        if columns is not None:
+            row = [row[i] if i < len(row) else xlrd.sheet.empty_cell
+                   for i in columns]
         row_values = []
         for cell in row:
             value = None
@@ -146,56 +290,476 @@ class XlData(SpreadsheetData):
         return self.sheet.nrows
 
 
+class XlsxData(SpreadsheetData):
+    '''Spreadsheet data in Excel 2007 (.xlsx) format. The rows are parsed
+    from the sheet's XML as they are needed, rather than the workbook being
+    held in memory (although the shared strings are). The first look_ahead
+    rows are kept, for finding the titles and first record.
+    Cells are as for XlData: whole numbers are ints, dates are
+    datetime.date and cells with no value return None.
+    @param sheet_index - if None, warn if more than 1 sheet in workbook.
+    '''
+    look_ahead = 100
+
+    def __init__(self, logger, filepath=None, buf=None, sheet_index=None):
+        super(XlsxData, self).__init__(logger, filepath, buf)
+        try:
+            self._zip = zipfile.ZipFile(filepath or cStringIO.StringIO(buf))
+            self._read_workbook()
+            self._shared_strings = self._read_shared_strings()
+            self._date_styles = self._read_date_styles()
+        except (zipfile.BadZipfile, KeyError, SyntaxError), e:
+            # (SyntaxError is the base of the XML ParseError)
+            raise ImportException('Could not open workbook: %r' % e)
+
+        if sheet_index == None:
+            if self.get_num_sheets() != 1:
+                logger.log.append('Warning: Just importing from sheet %r' % self.get_sheet_names()[0])
+            sheet_index = 0
+        self._sheet_index = sheet_index
+        self._head = None
+        self._num_rows = None
+
+    def _read_workbook(self):
+        '''Reads the names and paths of the sheets, and where the other
+        parts of the workbook are.'''
+        targets = {} # relationship id: path
+        paths_by_type = {}
+        rels_file = self._zip.open('xl/_rels/workbook.xml.rels')
+        try:
+            for event, elem in iterparse(rels_file):
+                if xml_local_name(elem.tag) == 'Relationship':
+                    target = elem.get('Target')
+                    if target.startswith('/'):
+                        path = target[1:]
+                    else:
+                        path = posixpath.normpath(posixpath.join('xl', target))
+                    targets[elem.get('Id')] = path
+                    paths_by_type[elem.get('Type').split('/')[-1]] = path
+        finally:
+            rels_file.close()
+        self._shared_strings_path = paths_by_type.get('sharedStrings')
+        self._styles_path = paths_by_type.get('styles')
+
+        self._sheets = [] # (name, path)
+        self._date1904 = False
+        workbook_file = self._zip.open('xl/workbook.xml')
+        try:
+            for event, elem in iterparse(workbook_file):
+                tag = xml_local_name(elem.tag)
+                if tag == 'sheet':
+                    rel_id = [value for key, value in elem.items()
+                              if xml_local_name(key) == 'id'][0]
+                    self._sheets.append((unicode(elem.get('name')),
+                                         targets[rel_id]))
+                elif tag == 'workbookPr':
+                    self._date1904 = elem.get('date1904') in ('1', 'true')
+        finally:
+            workbook_file.close()
+
+    def _read_shared_strings(self):
+        strings = []
+        if not self._shared_strings_path:
+            return strings
+        strings_file = self._zip.open(self._shared_strings_path)
+        try:
+            for event, elem in iterparse(strings_file):
+                if xml_local_name(elem.tag) == 'si':
+                    strings.append(xml_text(elem))
+                    elem.clear()
+        finally:
+            strings_file.close()
+        return strings
+
+    def _read_date_styles(self):
+        '''Returns the set of indexes of the cell styles that are dates.'''
+        if not self._styles_path:
+            return set()
+        custom_formats = {} # numFmtId: formatCode
+        cell_format_ids = []
+        in_cell_xfs = False
+        styles_file = self._zip.open(self._styles_path)
+        try:
+            for event, elem in iterparse(styles_file, events=('start', 'end')):
+                tag = xml_local_name(elem.tag)
+                if tag == 'cellXfs':
+                    in_cell_xfs = event == 'start'
+                elif event == 'end':
+                    if tag == 'numFmt':
+                        custom_formats[int(elem.get('numFmtId'))] = \
+                            elem.get('formatCode')
+                    elif tag == 'xf' and in_cell_xfs:
+                        cell_format_ids.append(int(elem.get('numFmtId', 0)))
+        finally:
+            styles_file.close()
+        date_styles = set()
+        for style_index, format_id in enumerate(cell_format_ids):
+            if format_id in custom_formats:
+                is_date = is_date_format_code(custom_formats[format_id])
+            else:
+                is_date = format_id in BUILTIN_DATE_FORMAT_IDS
+            if is_date:
+                date_styles.add(style_index)
+        return date_styles
+
+    def get_num_sheets(self):
+        return len(self._sheets)
+
+    def get_sheet_names(self):
+        return [name for name, path in self._sheets]
+
+    def get_data_by_sheet(self):
+        data_list = []
+        for sheet_index in range(self.get_num_sheets()):
+            # (shares the workbook)
+            data = copy.copy(self)
+            data._sheet_index = sheet_index
+            data._head = None
+            data._num_rows = None
+            data_list.append(data)
+        return data_list
+
+    def release(self):
+        self._head = None
+
+    def _read_rows(self, columns=None):
+        '''Yields the rows, parsing the sheet from the start. Missing rows
+        and cells are filled in with None.
+        @param columns - if given, the cells of other columns are None and
+                         are not converted
+        '''
+        wanted_columns = set(columns) if columns is not None else None
+        sheet_file = self._zip.open(self._sheets[self._sheet_index][1])
+        try:
+            num_cols = 0
+            next_row_index = 0
+            sheet_data = None
+            for event, elem in iterparse(sheet_file, events=('start', 'end')):
+                tag = xml_local_name(elem.tag)
+                if event == 'start':
+                    if tag == 'sheetData':
+                        sheet_data = elem
+                    continue
+                if tag == 'dimension':
+                    last_cell = elem.get('ref', 'A1').split(':')[-1]
+                    num_cols = xlsx_column_index(last_cell) + 1
+                elif tag == 'row':
+                    row = self._parse_row(elem, num_cols, wanted_columns)
+                    row_index = int(elem.get('r', next_row_index + 1)) - 1
+                    # free the parsed XML
+                    elem.clear()
+                    if sheet_data is not None:
+                        sheet_data.clear()
+                    while next_row_index < row_index:
+                        yield [None] * num_cols
+                        next_row_index += 1
+                    yield row
+                    next_row_index = row_index + 1
+        except SyntaxError, e:
+            raise ImportException('Workbook corrupt: %r' % e)
+        finally:
+            sheet_file.close()
+
+    def _parse_row(self, row_elem, num_cols, wanted_columns):
+        row = []
+        for cell in row_elem:
+            if xml_local_name(cell.tag) != 'c':
+                continue
+            ref = cell.get('r')
+            col_index = xlsx_column_index(ref) if ref else len(row)
+            row.extend([None] * (col_index - len(row)))
+            if wanted_columns is None or col_index in wanted_columns:
+                row.append(self._get_cell_value(cell))
+            else:
+                row.append(None)
+        row.extend([None] * (num_cols - len(row)))
+        return row
+
+    def _get_cell_value(self, cell):
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            for child in cell:
+                if xml_local_name(child.tag) == 'is':
+                    return xml_text(child)
+            return None
+        value = None
+        for child in cell:
+            if xml_local_name(child.tag) == 'v':
+                value = child.text
+        if value is None:
+            return None
+        if cell_type == 's':
+            return self._shared_strings[int(value)]
+        elif cell_type == 'str':
+            return unicode(value)
+        elif cell_type == 'n':
+            number = float(value)
+            if int(cell.get('s', 0)) in self._date_styles:
+                return xldate_to_date(number, self._date1904)
+            if number == int(number):
+                return int(number)
+            return number
+        elif cell_type == 'd':
+            return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+        elif cell_type == 'b':
+            return value == '1'
+        else:
+            raise ImportException, 'Unknown cell type: %s' % cell_type
+
+    def _get_head(self):
+        if self._head is None:
+            self._head = list(itertools.islice(self._read_rows(),
+                                               self.look_ahead))
+            if len(self._head) < self.look_ahead:
+                self._num_rows = len(self._head)
+        return self._head
+
+    def _project(self, row, columns):
+        if columns is None:
+            return list(row)
+        return [row[i] if i < len(row) else None for i in columns]
+
+    def get_row(self, row_index, columns=None):
+        head = self._get_head()
+        if row_index < len(head):
+            return self._project(head[row_index], columns)
+        rows = self._read_rows(columns)
+        try:
+            row = itertools.islice(rows, row_index, None).next()
+        except StopIteration:
+            raise IndexError('Row index out of range: %i' % row_index)
+        finally:
+            rows.close()
+        return self._project(row, columns)
+
+    def get_num_rows(self):
+        self._get_head()
+        if self._num_rows is None:
+            self._num_rows = sum(1 for row in self._read_rows())
+        return self._num_rows
+
+    def iter_rows(self, start=0, columns=None):
+        head = self._get_head()
+        if self._num_rows == len(head):
+            # all the rows are in the head
+            for row in head[start:]:
+                yield self._project(row, columns)
+            return
+        for row in itertools.islice(self._read_rows(columns), start, None):
+            yield self._project(row, columns)
+
+# Number formats that Excel has built in, which are dates
+BUILTIN_DATE_FORMAT_IDS = set(range(14, 23) + range(27, 37) + range(45, 48) +
+                              range(50, 59))
+
+def xml_local_name(tag):
+    '''Returns the tag without its namespace.'''
+    return tag.rsplit('}', 1)[-1]
+
+def xml_text(elem):
+    '''Returns the text of an Excel string element (shared or inline),
+    which is either in a <t> or split between runs <r><t>.'''
+    texts = []
+    for child in elem:
+        tag = xml_local_name(child.tag)
+        if tag == 't':
+            texts.append(child.text or u'')
+        elif tag == 'r':
+            texts.extend(t.text or u'' for t in child
+                         if xml_local_name(t.tag) == 't')
+    return u''.join(unicode(text) for text in texts)
+
+def xlsx_column_index(cell_ref):
+    '''Returns the column index of a cell reference e.g. 'AB12' -> 27'''
+    col_index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        col_index = col_index * 26 + ord(char.upper()) - ord('A') + 1
+    return col_index - 1
+
+def is_date_format_code(format_code):
+    '''Returns whether an Excel number format is for dates/times.'''
+    # ignore quoted text, escaped characters, colours and the like
+    format_code = re.sub(r'"[^"]*"|\\.|\[[^\]]*\]|[_*].', '', format_code)
+    return bool(re.search('[dmyhs]', format_code.lower()))
+
+def xldate_to_date(xldate, date1904=False):
+    '''Converts an Excel date (a number of days) to a datetime.date.'''
+    days = int(xldate)
+    if date1904:
+        return datetime.date(1904, 1, 1) + datetime.timedelta(days)
+    if days < 60:
+        # before Excel's non-existent 29th Feb 1900
+        return datetime.date(1899, 12, 31) + datetime.timedelta(days)
+    return datetime.date(1899, 12, 30) + datetime.timedelta(days)
+
+
+# Spreadsheet formats that open_spreadsheet_data can detect:
+# [(name, opener, matches_header, extensions, reads_gzip), ...]
+spreadsheet_formats = []
+
+GZIP_MAGIC = '\x1f\x8b'
+# number of bytes at the start of a file that formats are detected by
+HEADER_SIZE = 2048
+
+def register_spreadsheet_format(name, opener, matches_header=None,
+                                extensions=(), reads_gzip=False):
+    '''Adds a format that open_spreadsheet_data can detect and read.
+    Formats registered later are tried first, so can take the place of
+    earlier ones.
+
+    @param opener - callable (logger, filepath=None, buf=None) returning a
+                    SpreadsheetData (or a list of them, one per sheet). None
+                    means the format is recognised, but not supported.
+    @param matches_header - callable (header) returning whether a file
+                    starting with these bytes is in this format
+    @param extensions - file extensions e.g. ['.csv'], for when no format
+                    recognises the header
+    @param reads_gzip - whether the opener can read the file gzipped. If
+                    not, it is given the decompressed data as a buf.
+    '''
+    spreadsheet_formats.insert(0, (name, opener, matches_header,
+                                   tuple(extensions), reads_gzip))
+
+def detect_spreadsheet_format(header, filepath=None):
+    '''Works out the format of a spreadsheet from its first bytes, or
+    failing that, its file extension.
+    @return (name, opener, reads_gzip)
+    '''
+    for name, opener, matches_header, extensions, reads_gzip in \
+            spreadsheet_formats:
+        if matches_header and matches_header(header):
+            return (name, opener, reads_gzip)
+    if filepath:
+        extension = os.path.splitext(filepath)[1].lower()
+        for name, opener, matches_header, extensions, reads_gzip in \
+                spreadsheet_formats:
+            if extension in extensions:
+                return (name, opener, reads_gzip)
+    raise ImportException('Could not recognise the spreadsheet format of %s'
+                          % (filepath or 'the data'))
+
+def open_spreadsheet_data(logger, filepath=None, buf=None):
+    '''Opens a spreadsheet of any registered format.
+    @return a SpreadsheetData, or a list of them, one per sheet
+    '''
+    if filepath:
+        f = open(filepath, 'rb')
+        try:
+            header = f.read(HEADER_SIZE)
+        finally:
+            f.close()
+    else:
+        header = buf[:HEADER_SIZE]
+    if header.startswith(GZIP_MAGIC):
+        compressed_file = gzip.open(filepath, 'rb') if filepath else \
+                          gzip.GzipFile(fileobj=cStringIO.StringIO(buf))
+        try:
+            header = compressed_file.read(HEADER_SIZE)
+            name, opener, reads_gzip = detect_spreadsheet_format(
+                header, os.path.splitext(filepath)[0] if filepath else None)
+            if opener and not reads_gzip:
+                # decompress it all, since this format needs it
+                buf = header + compressed_file.read()
+                filepath = None
+        finally:
+            compressed_file.close()
+    else:
+        name, opener, reads_gzip = detect_spreadsheet_format(header, filepath)
+    if not opener:
+        raise ImportException('Spreadsheet format not supported: %s' % name)
+    return opener(logger, filepath=filepath, buf=buf)
+
+def open_xl_data(logger, filepath=None, buf=None):
+    data = XlData(logger, filepath=filepath, buf=buf, sheet_index=0)
+    if data.get_num_sheets() > 1:
+        return data.get_data_by_sheet()
+    return data
+
+def open_xlsx_data(logger, filepath=None, buf=None):
+    data = XlsxData(logger, filepath=filepath, buf=buf, sheet_index=0)
+    if data.get_num_sheets() > 1:
+        return data.get_data_by_sheet()
+    return data
+
+def is_text(header):
+    return '\x00' not in header
+
+def is_ole2(header):
+    return header.startswith('\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1')
+
+def is_xlsx(header):
+    return header.startswith('PK\x03\x04') and \
+           ('[Content_Types].xml' in header or 'xl/' in header)
+
+def is_ods(header):
+    return header.startswith('PK\x03\x04') and \
+           'mimetypeapplication/vnd.oasis.opendocument.spreadsheet' in header
+
+register_spreadsheet_format('csv', CsvData, is_text, ['.csv', '.txt'],
+                            reads_gzip=True)
+register_spreadsheet_format('xls', open_xl_data, is_ole2, ['.xls'])
+register_spreadsheet_format('xlsx', open_xlsx_data, is_xlsx, ['.xlsx'])
+register_spreadsheet_format('ods', None, is_ods, ['.ods'])
+
+
 class SpreadsheetDataRecords(DataRecords):
     '''Takes SpreadsheetData and converts it its titles and
     data records. Handles title rows and filters out rows of rubbish.
+    @param titles_to_import - if given, records only have the values for
+                              these titles, and the other columns are not
+                              read.
     '''
-    def __init__(self, spreadsheet_data, essential_title):
+    def __init__(self, spreadsheet_data, essential_title,
+                 titles_to_import=None):
         assert isinstance(spreadsheet_data, SpreadsheetData), spreadsheet_data
         self._data = spreadsheet_data
         # find titles row
         self.titles, last_titles_row_index = self.find_titles(essential_title)
         self._first_record_row = self.find_first_record_row(last_titles_row_index + 1)     
+        if titles_to_import is None:
+            self._columns = None
+        else:
+            self._columns = [i for i, title in enumerate(self.titles)
+                             if title is not None and title in titles_to_import]
 
     def find_titles(self, essential_title):
-        row_index = 0
         titles = []
         essential_title_lower = essential_title.lower()
-        while True:
-            if row_index >= self._data.get_num_rows():
-                raise ImportException('Could not find title row')
-            row = self._data.get_row(row_index)
+        for row_index, row in enumerate(self._data.iter_rows()):
             if essential_title in row or essential_title_lower in row:
                 for row_val in row:
                     titles.append(row_val.strip() if isinstance(row_val, basestring) else None)
                 return (titles, row_index)
-            row_index += 1
+        raise ImportException('Could not find title row')
 
     def find_first_record_row(self, row_index_to_start_looking):
-        row_index = row_index_to_start_looking
-        while True:
-            if row_index >= self._data.get_num_rows():
-                raise ImportException('Could not find first record row')
-            row = self._data.get_row(row_index)
+        for row_index, row in enumerate(
+                self._data.iter_rows(row_index_to_start_looking),
+                row_index_to_start_looking):
             if not (u'<< Datasets Displayed Below' in row or\
                     row[:5] == [None, None, None, None, None] or\
                     row[:5] == ['', '', '', '', '']\
                     ):
                 return row_index
-            row_index += 1
+        raise ImportException('Could not find first record row')
 
     @property
     def records(self):
         '''Returns each record as a dict.'''
-        for row_index in range(self._first_record_row, self._data.get_num_rows()):
-            row = self._data.get_row(row_index)
+        if self._columns is None:
+            titles = self.titles
+        else:
+            titles = [self.titles[i] for i in self._columns]
+        for row in self._data.iter_rows(self._first_record_row, self._columns):
             row_has_content = False
             for cell in row:
                 if cell:
                     row_has_content = True
                     break
             if row_has_content:
-                record_dict = OrderedDict(zip(self.titles, row))
+                record_dict = OrderedDict(zip(titles, row))
                 if record_dict.has_key(None):
                     del record_dict[None]
                 yield record_dict
@@ -210,15 +774,8 @@ class SpreadsheetPackageImporter(PackageImporter):
         super(SpreadsheetPackageImporter, self).__init__(**kwargs)
         
     def import_into_package_records(self):
-        try: 
-            package_data = CsvData(self.log, filepath=self._filepath,
-                                   buf=self._buf)
-        except ImportException:
-            package_data = XlData(self.log, filepath=self._filepath,
-                                  buf=self._buf, sheet_index=0)
-            if package_data.get_num_sheets() > 1:
-                package_data = [XlData(self.log, filepath=self._filepath,
-                                  buf=self._buf, sheet_index=i) for i in range(package_data.get_num_sheets())]
+        package_data = open_spreadsheet_data(self.log, filepath=self._filepath,
+                                             buf=self._buf)
         self._package_data_records = MultipleSpreadsheetDataRecords(
             data_list=package_data,
             record_params=self._record_params,
@@ -295,13 +852,20 @@ class MultipleSpreadsheetDataRecords(DataRecords):
         self.records_list = []
         if not isinstance(data_list, (list, tuple)):
             data_list = [data_list]
+        self._data_list = data_list
         for data in data_list:
             self.records_list.append(record_class(data, *record_params))
+            if len(data_list) > 1:
+                # only hold one sheet in memory at a time
+                data.release()
             
     @property
     def records(self):
-        for spreadsheet_records in self.records_list:
+        for data, spreadsheet_records in zip(self._data_list,
+                                             self.records_list):
             for spreadsheet_record in spreadsheet_records.records:
                 yield spreadsheet_record
+            if len(self._data_list) > 1:
+                data.release()
 
         
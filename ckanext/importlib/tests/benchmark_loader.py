@@ -0,0 +1,238 @@
+'''
+Benchmarks of the loaders against MockCkanServer, with simulated network
+latency. For each loader and corpus it reports the wall time, datasets per
+second and the API calls per dataset of each type.
+
+The number of API calls per dataset largely decides the run time of a
+real load, so the benchmark fails if it exceeds CALL_BUDGETS. (If a change
+makes fewer calls, lower the budget to match.)
+
+    python -m ckanext.importlib.tests.benchmark_loader --latency 0.005
+'''
+import sys
+import time
+from optparse import OptionParser
+
+from ckanext.importlib.loader import ReplaceByNameLoader, \
+     ReplaceByExtraFieldLoader, ResourceSeriesLoader
+from ckanext.importlib.tests.mock_ckanclient import MockCkanServer
+
+NUM_DATASETS = 200
+NUM_SERIES = 10 # packages the resource series corpora are spread over
+NUM_NAMES = 10 # names the name clash corpus uses
+
+# Maximum API calls per dataset loaded, by (loader, corpus) and call type,
+# when loading NUM_DATASETS.
+CALL_BUDGETS = {
+    ('name', 'new'): {'package_entity_get': 2.0,
+                      'package_register_post': 1.0},
+    ('name', 'unchanged'): {'package_entity_get': 1.0},
+    ('name', 'changed'): {'package_entity_get': 1.0,
+                          'package_entity_put': 0.1},
+    ('extra', 'new'): {'package_search': 1.0,
+                       'package_entity_get': 2.0,
+                       'package_register_post': 1.0},
+    ('extra', 'unchanged'): {'package_search': 1.0},
+    ('extra', 'changed'): {'package_search': 1.0,
+                           'package_entity_put': 0.1},
+    ('extra', 'name_clashes'): {'package_search': 2.9,
+                                'package_entity_get': 2.25,
+                                'package_register_post': 1.0},
+    ('series', 'series'): {'package_search': 1.0,
+                           'package_entity_get': 0.1,
+                           'package_register_post': 0.05,
+                           'package_entity_put': 0.95},
+    ('series', 'synonyms'): {'package_search': 1.17,
+                             'package_entity_get': 0.1,
+                             'package_register_post': 0.05,
+                             'package_entity_put': 0.95},
+    ('coalesce', 'series'): {'package_search': 0.05,
+                             'package_entity_get': 0.1,
+                             'package_register_post': 0.05},
+    ('coalesce', 'synonyms'): {'package_search': 0.2,
+                               'package_entity_get': 0.1,
+                               'package_register_post': 0.05},
+    }
+
+class SeriesLoader(ResourceSeriesLoader):
+    def __init__(self, ckanclient, synonyms=None, **kwargs):
+        super(SeriesLoader, self).__init__(
+            ckanclient, ['title', 'department'],
+            field_keys_to_expect_invariant=['country'],
+            synonyms=synonyms, **kwargs)
+
+    def _get_resource_id(self, res):
+        return res['description']
+
+LOADERS = {
+    'name': ReplaceByNameLoader,
+    'extra': lambda ckanclient, **kwargs: \
+             ReplaceByExtraFieldLoader(ckanclient, 'ref', **kwargs),
+    'series': SeriesLoader,
+    'coalesce': lambda ckanclient, **kwargs: \
+                SeriesLoader(ckanclient, coalesce=True, **kwargs),
+    }
+
+# Corpora
+
+def dataset(i, title=None):
+    return {'name': u'dataset-%i' % i,
+            'title': title or u'Dataset %i' % i,
+            'notes': u'Notes about dataset %i' % i,
+            'license_id': u'uk-ogl',
+            'tags': [u'tag%i' % (i % 7), u'benchmark'],
+            'extras': {u'ref': u'ref-%i' % i,
+                       u'department': u'Department %i' % (i % 5)},
+            'resources': [{'url': u'http://example.com/%i.csv' % i,
+                           'format': u'CSV',
+                           'description': u'Data %i' % i}]}
+
+def series_row(i, department=None):
+    series = i % NUM_SERIES
+    return {'name': u'series-%i' % series,
+            'title': u'Series %i' % series,
+            'extras': {u'department': department or u'Dept %i' % series,
+                       u'country': u'UK'},
+            'resources': [{'url': u'http://example.com/series/%i.csv' % i,
+                           'format': u'CSV',
+                           'description': u'series/id/%i' % i}]}
+
+def corpus_new(num):
+    return [], [dataset(i) for i in range(num)]
+
+def corpus_unchanged(num):
+    pkg_dicts = [dataset(i) for i in range(num)]
+    return pkg_dicts, pkg_dicts
+
+def corpus_changed(num):
+    '''10% of the datasets changed'''
+    existing = [dataset(i) for i in range(num)]
+    return existing, [dataset(i, title=u'Changed %i' % i)
+                      if i % 10 == 0 else dataset(i)
+                      for i in range(num)]
+
+def corpus_name_clashes(num):
+    '''The datasets would like one of only a few names, each of which is
+    taken by several existing packages.'''
+    existing = [dict(dataset(num + i),
+                     name=u'dataset-%i' % (i % NUM_NAMES) + '_' * (i / NUM_NAMES))
+                for i in range(NUM_NAMES * 5)]
+    return existing, [dict(dataset(i), name=u'dataset-%i' % (i % NUM_NAMES))
+                      for i in range(num)]
+
+def corpus_series(num):
+    '''A long series of resources, for a few packages'''
+    return [], [series_row(i) for i in range(num)]
+
+def corpus_synonyms(num):
+    '''A series where the department is given by alternative names'''
+    return [], [series_row(i, department=u'Dept %i%s' % (
+        i % NUM_SERIES, 'abc'[i % 3])) for i in range(num)]
+
+CORPORA = {
+    'new': corpus_new,
+    'unchanged': corpus_unchanged,
+    'changed': corpus_changed,
+    'name_clashes': corpus_name_clashes,
+    'series': corpus_series,
+    'synonyms': corpus_synonyms,
+    }
+
+def synonyms_for(corpus_name):
+    if corpus_name != 'synonyms':
+        return {}
+    return {'department': [tuple(u'Dept %i%s' % (series, letter)
+                                 for letter in 'abc')
+                           for series in range(NUM_SERIES)]}
+
+# Running
+
+def run(loader_name, corpus_name, num_datasets=NUM_DATASETS, latency=0,
+        workers=None):
+    '''Loads a corpus with a loader, against a new MockCkanServer.
+    @return dict of results
+    '''
+    existing, pkg_dicts = CORPORA[corpus_name](num_datasets)
+    server = MockCkanServer()
+    loader_kwargs = {}
+    if loader_name in ('series', 'coalesce'):
+        loader_kwargs['synonyms'] = synonyms_for(corpus_name)
+    # existing packages are loaded with a separate loader, so that the
+    # benchmarked one starts with nothing cached
+    if existing:
+        if corpus_name == 'name_clashes':
+            for pkg_dict in existing:
+                server.add_package(pkg_dict)
+        else:
+            LOADERS[loader_name](server.new_client(), **loader_kwargs)\
+                .load_packages(existing)
+    loader = LOADERS[loader_name](server.new_client(), **loader_kwargs)
+    server.reset_calls()
+    server.latency = latency
+
+    start = time.time()
+    res = loader.load_packages(pkg_dicts, workers=workers,
+                               ckanclient_factory=server.new_client)
+    duration = time.time() - start
+
+    assert res['num_errors'] == 0, res
+    return {'loader': loader_name, 'corpus': corpus_name,
+            'num_datasets': len(pkg_dicts),
+            'duration': duration,
+            'datasets_per_second': len(pkg_dicts) / duration \
+                                   if duration else None,
+            'calls_per_dataset': dict((method_name,
+                                       float(num) / len(pkg_dicts))
+                                      for method_name, num
+                                      in server.calls.items())}
+
+def run_all(num_datasets=NUM_DATASETS, latency=0, workers=None):
+    return [run(loader_name, corpus_name, num_datasets, latency, workers)
+            for loader_name, corpus_name in sorted(CALL_BUDGETS)]
+
+def check_budgets(results):
+    '''@return list of messages about where calls exceed CALL_BUDGETS'''
+    overruns = []
+    for result in results:
+        budget = CALL_BUDGETS[(result['loader'], result['corpus'])]
+        for method_name, num in sorted(result['calls_per_dataset'].items()):
+            if num > budget.get(method_name, 0) + 1e-9:
+                overruns.append('%s/%s: %.2f %s calls per dataset (budget '
+                                '%.2f)' % (result['loader'], result['corpus'],
+                                           num, method_name,
+                                           budget.get(method_name, 0)))
+    return overruns
+
+def report(results):
+    lines = ['%-8s %-13s %8s %9s  %s' % ('loader', 'corpus', 'time/s',
+                                         'datasets/s', 'calls per dataset')]
+    for result in results:
+        calls = ', '.join('%s %.2f' % (method_name, num)
+                          for method_name, num
+                          in sorted(result['calls_per_dataset'].items()))
+        lines.append('%-8s %-13s %8.3f %9.1f  %s' % (
+            result['loader'], result['corpus'], result['duration'],
+            result['datasets_per_second'] or 0, calls))
+    return '\n'.join(lines)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--num-datasets', dest='num_datasets', type='int',
+                      default=NUM_DATASETS)
+    parser.add_option('--latency', dest='latency', type='float', default=0,
+                      help='seconds added to each API call')
+    parser.add_option('--workers', dest='workers', type='int', default=None)
+    options, args = parser.parse_args()
+    results = run_all(options.num_datasets, options.latency, options.workers)
+    print report(results)
+    if options.num_datasets != NUM_DATASETS or options.workers:
+        print '(API call budgets are only checked for %i datasets loaded ' \
+              'sequentially)' % NUM_DATASETS
+        return
+    overruns = check_budgets(results)
+    if overruns:
+        print 'API calls over budget:\n  %s' % '\n  '.join(overruns)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
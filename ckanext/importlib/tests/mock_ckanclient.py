@@ -0,0 +1,471 @@
+'''
+An in-memory stand-in for a CKAN server and ckanclient, implementing the
+parts of the API that the loaders use. It needs no CKAN install, so the
+loaders can be tested and benchmarked offline and in milliseconds.
+
+    server = MockCkanServer(latency=0.01)
+    server.add_package({'name': 'existing', 'title': 'Existing'})
+    loader = ReplaceByNameLoader(server.new_client())
+    loader.load_packages(pkg_dicts, workers=4,
+                         ckanclient_factory=server.new_client)
+    print server.calls
+
+Each client has its own last_status/last_message etc, like a CkanClient,
+and the server they share is thread-safe. It counts the calls made by each
+method, can make each call take a given time, and can be told to fail
+calls with a given HTTP status.
+'''
+import re
+import copy
+import json
+import time
+import uuid
+import random
+import datetime
+import threading
+
+from ckanclient import CkanApiError, CkanApiNotFoundError, \
+     CkanApiNotAuthorizedError, CkanApiConflictError
+try:
+    from ckanclient import CkanApiActionError
+except ImportError:
+    CkanApiActionError = CkanApiError
+
+PAGE_SIZE = 10 # search results per page, when no limit is given
+               # (as ckanclient)
+
+# Fields of a package that search_options can match, which are not extras
+PACKAGE_FIELDS = ('name', 'title', 'notes', 'url', 'author', 'author_email',
+                  'maintainer', 'maintainer_email', 'license_id', 'version',
+                  'state', 'tags', 'groups')
+
+# search_options which are not fields to match
+SEARCH_PARAMS = ('q', 'limit', 'offset', 'all_fields', 'order_by',
+                 'filter_by_openid', 'filter_by_downloadable')
+
+VALID_NAME = re.compile('^[a-z0-9_-]{2,100}$')
+
+class MockCkanServer(object):
+    '''The packages and groups of a CKAN server, held in memory.
+    @param latency - seconds each call takes, or a dict of them by method
+                     name (with None giving the default)
+    @param failure_rate - proportion of calls that fail (at random) with
+                     failure_status
+    @param seed - for the random failures
+    @param supports_solr_queries - whether a search's 'q' may use SOLR
+                     field queries (as CKAN 1.5 onwards)
+    @param supports_actions - whether the Action API is available
+    @param text_search_only - whether a search's 'q' is only matched as
+                     text (in the name, title and notes), so that SOLR
+                     field queries silently find nothing
+    '''
+    def __init__(self, latency=0, failure_rate=0, failure_status=500,
+                 seed=None, supports_solr_queries=True,
+                 supports_actions=True, text_search_only=False):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.supports_solr_queries = supports_solr_queries
+        self.supports_actions = supports_actions
+        self.text_search_only = text_search_only
+        self.packages = {} # id: package dict
+        self.groups = {} # name: group dict
+        self.calls = {} # method name: number of calls
+        self._ids_by_name = {}
+        self._injected_failures = {} # method name: [status, ...]
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._last_modified = datetime.datetime(2012, 1, 1)
+
+    def new_client(self):
+        '''Returns a new client of this server (and can be used as a
+        loader's ckanclient_factory).'''
+        return MockCkanClient(self)
+
+    @property
+    def num_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    def inject_failure(self, method_name, status=500, count=1):
+        '''Makes the next count calls of the method fail with the status.
+        (method_name can be an action name e.g. 'member_create'.)'''
+        with self._lock:
+            self._injected_failures.setdefault(method_name, []).extend(
+                [status] * count)
+
+    def add_package(self, pkg_dict, state='active'):
+        '''Creates a package directly (not counted as a call).
+        @return the package dict'''
+        with self._lock:
+            return self._create_package(pkg_dict, state=state)
+
+    def add_group(self, name, pkg_names=None):
+        with self._lock:
+            self.groups[name] = {'name': name, 'title': name,
+                                 'packages': list(pkg_names or [])}
+            return copy.deepcopy(self.groups[name])
+
+    def get_package(self, pkg_ref):
+        '''Returns a package directly (not counted as a call), or None.'''
+        with self._lock:
+            pkg = self._find_package(pkg_ref)
+            return copy.deepcopy(pkg) if pkg else None
+
+    def call(self, method_name, function, *args):
+        '''Counts the call, waits for the latency, fails it if required,
+        and otherwise calls the function with the args, under the lock.
+        @return (status, result)'''
+        with self._lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+            failures = self._injected_failures.get(method_name)
+            if failures:
+                status = failures.pop(0)
+            elif self.failure_rate and \
+                     self._random.random() < self.failure_rate:
+                status = self.failure_status
+            else:
+                status = None
+        latency = self.latency.get(method_name, self.latency.get(None, 0)) \
+                  if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+        if status:
+            return status, 'Injected failure'
+        with self._lock:
+            return function(*args)
+
+    # The following are called under the lock, and return (status, result)
+
+    def _find_package(self, pkg_ref):
+        pkg_id = pkg_ref if pkg_ref in self.packages \
+                 else self._ids_by_name.get(pkg_ref)
+        return self.packages.get(pkg_id)
+
+    def _next_modified(self):
+        self._last_modified += datetime.timedelta(seconds=1)
+        return self._last_modified.isoformat()
+
+    def _create_package(self, pkg_dict, state='active'):
+        pkg = serialised(pkg_dict)
+        pkg['id'] = str(uuid.uuid4())
+        pkg['state'] = state
+        pkg['metadata_modified'] = self._next_modified()
+        pkg['extras'] = pkg.get('extras') or {}
+        pkg['tags'] = pkg.get('tags') or []
+        pkg['groups'] = pkg.get('groups') or []
+        pkg['resources'] = [self._new_resource(res, pkg['id'])
+                            for res in pkg.get('resources') or []]
+        self.packages[pkg['id']] = pkg
+        self._ids_by_name[pkg['name']] = pkg['id']
+        return copy.deepcopy(pkg)
+
+    def _new_resource(self, res, pkg_id):
+        res = dict(res)
+        res.setdefault('id', str(uuid.uuid4()))
+        res['package_id'] = pkg_id
+        return res
+
+    def package_entity_get(self, pkg_ref):
+        pkg = self._find_package(pkg_ref)
+        if not pkg:
+            return 404, 'Not found'
+        return 200, copy.deepcopy(pkg)
+
+    def package_register_post(self, pkg_dict):
+        name = pkg_dict.get('name') or ''
+        if not VALID_NAME.match(name):
+            return 409, {'name': ['Url must be purely lowercase alphanumeric (ascii) characters and these symbols: -_']}
+        if name in self._ids_by_name:
+            return 409, {'name': ['Package name already exists in database']}
+        return 201, self._create_package(pkg_dict)
+
+    def package_entity_put(self, pkg_dict, pkg_ref):
+        # As the REST API, fields not given are left as they are
+        pkg = self._find_package(pkg_ref)
+        if not pkg:
+            return 404, 'Not found'
+        pkg_dict = serialised(pkg_dict)
+        pkg_dict.pop('id', None)
+        new_name = pkg_dict.get('name', pkg['name'])
+        if new_name != pkg['name']:
+            if not VALID_NAME.match(new_name) or \
+                   new_name in self._ids_by_name:
+                return 409, {'name': ['Invalid or existing name']}
+            del self._ids_by_name[pkg['name']]
+            self._ids_by_name[new_name] = pkg['id']
+        if 'resources' in pkg_dict:
+            pkg_dict['resources'] = [self._new_resource(res, pkg['id'])
+                                     for res in pkg_dict['resources'] or []]
+        pkg.update(pkg_dict)
+        pkg['metadata_modified'] = self._next_modified()
+        return 200, copy.deepcopy(pkg)
+
+    def package_search(self, q, search_options):
+        if q and not self.supports_solr_queries:
+            return 400, 'Bad request - q must be plain text'
+        if self.text_search_only:
+            q_matches = lambda pkg: not q or any(
+                q.lower() in (pkg.get(key) or '').lower()
+                for key in ('name', 'title', 'notes'))
+        else:
+            try:
+                q_matches = parse_query(q)
+            except ValueError, e:
+                return 400, 'Bad request - could not parse q: %s' % e
+        field_options = dict((key, value)
+                             for key, value in search_options.items()
+                             if key not in SEARCH_PARAMS)
+        matches = [pkg for pkg in self.packages.values()
+                   if pkg['state'] == 'active' and q_matches(pkg) and
+                   matches_options(pkg, field_options)]
+        matches.sort(key=lambda pkg: pkg['name'])
+        offset = int(search_options.get('offset') or 0)
+        limit = int(search_options.get('limit') or PAGE_SIZE)
+        page = matches[offset:offset + limit]
+        if search_options.get('all_fields'):
+            results = copy.deepcopy(page)
+        else:
+            results = [pkg['name'] for pkg in page]
+        return 200, {'count': len(matches), 'results': results}
+
+    def group_entity_get(self, group_name):
+        group = self.groups.get(group_name)
+        if not group:
+            return 404, 'Not found'
+        return 200, copy.deepcopy(group)
+
+    def group_entity_put(self, group_dict, group_name):
+        if group_name not in self.groups:
+            return 404, 'Not found'
+        group_dict = serialised(group_dict)
+        self.groups[group_name].update(group_dict)
+        return 200, copy.deepcopy(self.groups[group_name])
+
+    def action(self, action_name, data_dict):
+        if not self.supports_actions:
+            return 404, 'Not found'
+        function = getattr(self, 'action_%s' % action_name, None)
+        if not function:
+            return 400, 'Bad request - Action name not known: %s' % \
+                   action_name
+        result = function(serialised(data_dict))
+        if isinstance(result, basestring):
+            return 200, {'help': '', 'success': False,
+                         'error': {'message': result}}
+        return 200, {'help': '', 'success': True, 'result': result}
+
+    def action_resource_create(self, data_dict):
+        pkg = self._find_package(data_dict.pop('package_id', None))
+        if not pkg:
+            return 'Package not found'
+        res = self._new_resource(data_dict, pkg['id'])
+        pkg['resources'].append(res)
+        pkg['metadata_modified'] = self._next_modified()
+        return copy.deepcopy(res)
+
+    def action_resource_update(self, data_dict):
+        for pkg in self.packages.values():
+            for i, res in enumerate(pkg['resources']):
+                if res['id'] == data_dict.get('id'):
+                    pkg['resources'][i] = self._new_resource(data_dict,
+                                                             pkg['id'])
+                    pkg['metadata_modified'] = self._next_modified()
+                    return copy.deepcopy(pkg['resources'][i])
+        return 'Resource not found'
+
+    def action_member_create(self, data_dict):
+        group = self.groups.get(data_dict.get('id'))
+        if not group:
+            return 'Group not found'
+        if data_dict.get('object') not in group['packages']:
+            group['packages'].append(data_dict['object'])
+        return dict(data_dict, table_name=data_dict.get('object_type'))
+
+    def action_package_show(self, data_dict):
+        pkg = self._find_package(data_dict.get('id'))
+        if not pkg:
+            return 'Package not found'
+        return copy.deepcopy(pkg)
+
+    def action_package_list(self, data_dict):
+        return sorted(pkg['name'] for pkg in self.packages.values()
+                      if pkg['state'] == 'active')
+
+
+class MockCkanClient(object):
+    '''Implements the ckanclient methods used by the loaders, against a
+    MockCkanServer.'''
+    def __init__(self, server):
+        self.server = server
+        self.reset()
+
+    def reset(self):
+        self.last_status = None
+        self.last_message = None
+        self.last_result = None
+        self.last_ckan_error = None
+
+    def _call(self, method_name, function_name, *args):
+        self.reset()
+        function = getattr(self.server, function_name)
+        self.last_status, self.last_message = \
+                          self.server.call(method_name, function, *args)
+        if self.last_status not in (200, 201):
+            if self.last_status == 404:
+                raise CkanApiNotFoundError(self.last_status)
+            elif self.last_status == 403:
+                raise CkanApiNotAuthorizedError(self.last_status)
+            elif self.last_status == 409:
+                raise CkanApiConflictError(self.last_status)
+            else:
+                raise CkanApiError(self.last_message)
+        return self.last_message
+
+    def is_id(self, id_string):
+        return bool(re.match('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', id_string))
+
+    def package_entity_get(self, package_name):
+        return self._call('package_entity_get', 'package_entity_get',
+                          package_name)
+
+    def package_register_post(self, package_dict):
+        return self._call('package_register_post', 'package_register_post',
+                          package_dict)
+
+    def package_entity_put(self, package_dict, package_name=None):
+        return self._call('package_entity_put', 'package_entity_put',
+                          package_dict, package_name or package_dict['name'])
+
+    def group_entity_get(self, group_name):
+        return self._call('group_entity_get', 'group_entity_get',
+                          group_name)
+
+    def group_entity_put(self, group_dict, group_name=None):
+        return self._call('group_entity_put', 'group_entity_put',
+                          group_dict, group_name or group_dict['name'])
+
+    def package_search(self, q, search_options=None):
+        search_options = dict(search_options or {})
+        if not search_options.get('limit'):
+            search_options['limit'] = PAGE_SIZE
+        result = self._call('package_search', 'package_search',
+                            q, search_options)
+        if not search_options.get('offset'):
+            result['results'] = self._result_generator(
+                result['count'], result['results'], q, search_options)
+        return result
+
+    def _result_generator(self, count, results, q, search_options):
+        # pages through the results, as ckanclient does
+        offset = 0
+        while True:
+            for res in results:
+                yield res
+            offset += search_options['limit']
+            if offset >= count:
+                break
+            search_options = dict(search_options, offset=offset)
+            results = self.package_search(q, search_options)['results']
+
+    def action(self, action_name, **kwargs):
+        message = self._call(action_name, 'action', action_name, kwargs)
+        if message['success']:
+            self.last_result = message['result']
+        else:
+            self.last_ckan_error = message['error']
+            raise CkanApiActionError(self.last_ckan_error)
+        return self.last_result
+
+    def package_show(self, package_id):
+        return self.action('package_show', id=package_id)
+
+    def package_list(self):
+        return self.action('package_list')
+
+
+def serialised(data):
+    '''Returns a copy of the data as if it had been sent as JSON.'''
+    return json.loads(json.dumps(data))
+
+def lower(value):
+    if isinstance(value, basestring):
+        return value.lower().strip()
+    return value
+
+def get_field(pkg, key):
+    if key in PACKAGE_FIELDS or key in pkg:
+        return pkg.get(key)
+    if key.startswith('extras_'):
+        key = key[len('extras_'):]
+    return (pkg.get('extras') or {}).get(key)
+
+def matches_options(pkg, field_options):
+    '''Whether the package has the values of the search_options, matching
+    case-insensitively, as SOLR does for text fields.'''
+    for key, value in field_options.items():
+        if not value_matches(get_field(pkg, key), lower(value)):
+            return False
+    return True
+
+def value_matches(pkg_value, value, prefix=False):
+    if isinstance(pkg_value, list):
+        return any(value_matches(item, value, prefix) for item in pkg_value)
+    pkg_value = lower(pkg_value)
+    if not isinstance(pkg_value, basestring):
+        return False
+    if prefix:
+        return pkg_value.startswith(value)
+    return pkg_value == value
+
+QUERY_TERM = re.compile(r'''
+    (?P<field>[\w-]+):
+    (?:
+      \((?P<alternatives>(?:\s*"(?:[^"\\]|\\.)*"\s*(?:OR)?)+)\)  # (\"a\" OR \"b\")
+     |(?P<prefix>(?:[^\s\\*]|\\.)+)\*                            # abc*
+     |"(?P<phrase>(?:[^"\\]|\\.)*)"                              # \"abc\"
+     |(?P<value>(?:[^\s\\]|\\.)+)                                # abc
+    )$''', re.VERBOSE)
+QUOTED = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+def unescape(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+def parse_query(q):
+    '''Parses a SOLR query of the restricted form used by the loaders:
+    terms of field:value, field:prefix* or field:("a" OR "b"), joined by
+    AND.
+    @return function which tells whether a package matches the query
+    '''
+    terms = [term.strip() for term in (q or '').split(' AND ')
+             if term.strip()]
+    conditions = []
+    for term in terms:
+        match = QUERY_TERM.match(term)
+        if not match:
+            raise ValueError('unsupported term %r' % term)
+        field = match.group('field')
+        if match.group('alternatives') is not None:
+            values = [lower(unescape(value)) for value in
+                      QUOTED.findall(match.group('alternatives'))]
+            prefix = False
+        elif match.group('prefix') is not None:
+            values = [lower(unescape(match.group('prefix')))]
+            prefix = True
+        else:
+            values = [lower(unescape(match.group('phrase') or
+                                     match.group('value')))]
+            prefix = False
+        conditions.append((field, values, prefix))
+    def q_matches(pkg):
+        for field, values, prefix in conditions:
+            pkg_value = get_field(pkg, field)
+            if not any(value_matches(pkg_value, value, prefix)
+                       for value in values):
+                return False
+        return True
+    return q_matches
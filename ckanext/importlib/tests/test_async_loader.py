@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import subprocess
+
+from nose.tools import assert_equal
+from nose.plugins.skip import SkipTest
+
+from ckanext.importlib.async_loader import AsyncReplaceByNameLoader
+from ckanext.importlib.loader import LoaderError
+from ckanext.importlib.tests.mock_ckanclient import MockCkanServer
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        '..', '..', '..'))
+
+# Run in its own process, since gevent's monkey-patching has to be done
+# before anything else is imported, and would affect the other tests.
+SMOKE_TEST_SCRIPT = '''
+from gevent import monkey; monkey.patch_all()
+import json
+from ckanext.importlib.async_loader import AsyncReplaceByNameLoader
+from ckanext.importlib.tests.mock_ckanclient import MockCkanServer
+
+server = MockCkanServer(latency=0.01)
+server.add_package({'name': u'pkg0', 'title': u'Old'})
+loader = AsyncReplaceByNameLoader(server.new_client(), concurrency=10)
+res = loader.load_packages(
+    ({'name': u'pkg%i' % i, 'title': u'Pkg %i' % i} for i in range(20)),
+    ckanclient_factory=server.new_client)
+print json.dumps({'num_loaded': res['num_loaded'],
+                  'pkg_names': res['pkg_names'],
+                  'num_packages': len(server.packages),
+                  'title': server.get_package('pkg0')['title']})
+'''
+
+class TestAsyncLoader:
+    def test_0_load_packages(self):
+        try:
+            import gevent
+        except ImportError:
+            raise SkipTest('gevent is not installed')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [REPO_DIR] + filter(None, [os.environ.get('PYTHONPATH')])))
+        process = subprocess.Popen([sys.executable, '-c', SMOKE_TEST_SCRIPT],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=env)
+        stdout, stderr = process.communicate()
+        assert_equal(process.returncode, 0, stderr)
+        res = json.loads(stdout.strip().splitlines()[-1])
+        assert_equal(res['num_loaded'], 20)
+        assert_equal(res['pkg_names'], ['pkg%i' % i for i in range(20)])
+        assert_equal(res['num_packages'], 20)
+        assert_equal(res['title'], 'Pkg 0')
+
+    def test_1_requires_gevent_patching(self):
+        # (this process is not monkey-patched, and may not have gevent)
+        server = MockCkanServer()
+        loader = AsyncReplaceByNameLoader(server.new_client())
+        try:
+            loader.load_packages([{'name': u'pkg', 'title': u'Pkg'}],
+                                 ckanclient_factory=server.new_client)
+        except LoaderError, e:
+            assert 'gevent' in str(e), e
+        else:
+            assert 0, 'Should have raised'
+        assert_equal(server.calls, {})
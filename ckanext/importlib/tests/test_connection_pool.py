@@ -0,0 +1,109 @@
+import threading
+import time
+import urllib2
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from nose.tools import assert_equal
+
+from ckanext.importlib.connection_pool import ConnectionPool, \
+     build_pooled_opener
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    '''Responds with the request method and path. If the server is set to
+    drop_connections, it closes each connection after the response, while
+    still letting the client think it will be kept alive.'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._respond()
+
+    def _respond(self):
+        self.server.requests.append((self.command, self.path))
+        status = 404 if self.path == '/missing' else 200
+        body = '%s %s' % (self.command, self.path)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.requests = []
+        self.drop_connections = False
+
+
+class TestConnectionPool:
+    def setup(self):
+        self.server = KeepAliveServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.pool = ConnectionPool()
+        self.opener = build_pooled_opener(self.pool)
+
+    def teardown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _open(self, path, data=None):
+        return self.opener.open(self.url + path, data).read()
+
+    def _let_server_drop_connection(self):
+        # give the server time to close the connection after its response
+        time.sleep(0.1)
+
+    def test_0_reuse(self):
+        assert_equal(self._open('/a'), 'GET /a')
+        assert_equal(self._open('/b', 'data'), 'POST /b')
+        assert_equal(self._open('/c'), 'GET /c')
+        assert_equal(self.pool.num_connections_made, 1)
+
+    def test_1_stale_connection_is_retried(self):
+        self.server.drop_connections = True
+        assert_equal(self._open('/a'), 'GET /a')
+        self._let_server_drop_connection()
+        assert_equal(self._open('/b'), 'GET /b')
+        assert_equal(self.pool.num_connections_made, 2)
+        assert_equal(self.server.requests, [('GET', '/a'), ('GET', '/b')])
+
+    def test_2_http_error(self):
+        try:
+            self._open('/missing')
+        except urllib2.HTTPError, e:
+            assert_equal(e.code, 404)
+            assert_equal(e.read(), 'GET /missing')
+        else:
+            assert 0, 'Should have raised'
+        # the connection is still reused after an error status
+        assert_equal(self._open('/a'), 'GET /a')
+        assert_equal(self.pool.num_connections_made, 1)
+
+    def test_3_post_on_stale_connection_is_not_retried(self):
+        self.server.drop_connections = True
+        assert_equal(self._open('/a'), 'GET /a')
+        self._let_server_drop_connection()
+        try:
+            self._open('/b', 'data')
+        except urllib2.URLError, e:
+            pass
+        else:
+            assert 0, 'Should have raised'
+        assert_equal(self.pool.num_connections_made, 1)
+        assert_equal(self.server.requests, [('GET', '/a')])
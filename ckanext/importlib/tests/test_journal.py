@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.importlib.journal import LoadJournal
+
+class TestLoadJournal:
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.dir, 'test.journal')
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_0_resume(self):
+        journal = LoadJournal(self.filepath)
+        journal.record('pkg1', 'hash1', 'loaded', {'id': 'id1', 'name': 'pkg1'})
+        journal.record('pkg2', 'hash2', 'error', {'name': 'pkg2'})
+        journal.close()
+
+        journal = LoadJournal(self.filepath)
+        assert_equal(journal.get_loaded('pkg1', 'hash1'),
+                     {'id': 'id1', 'name': 'pkg1'})
+        assert_equal(journal.get_loaded('pkg1', 'changed_hash'), None)
+        assert_equal(journal.get_loaded('pkg2', 'hash2'), None)
+        assert_equal(journal.num_loaded, 1)
+        journal.close()
+
+    def test_1_incomplete_last_line(self):
+        journal = LoadJournal(self.filepath)
+        journal.record('pkg1', 'hash1', 'loaded', {'id': 'id1', 'name': 'pkg1'})
+        journal.close()
+        f = open(self.filepath, 'a')
+        f.write('{"identity": "pkg2", "ha')
+        f.close()
+
+        journal = LoadJournal(self.filepath)
+        assert_equal(journal.num_loaded, 1)
+        journal.record('pkg3', 'hash3', 'loaded', {'id': 'id3', 'name': 'pkg3'})
+        journal.close()
+
+        journal = LoadJournal(self.filepath)
+        assert_equal(journal.num_loaded, 2)
+        journal.close()
+
+    def test_2_later_error_supersedes(self):
+        journal = LoadJournal(self.filepath, sync_every=1)
+        journal.record('pkg1', 'hash1', 'loaded', {'id': 'id1', 'name': 'pkg1'})
+        journal.record('pkg1', 'hash1', 'error', {'name': 'pkg1'})
+        assert_equal(journal.get_loaded('pkg1', 'hash1'), None)
+        journal.close()
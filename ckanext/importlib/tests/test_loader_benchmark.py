@@ -0,0 +1,8 @@
+from nose.tools import assert_equal
+
+from ckanext.importlib.tests import benchmark_loader
+
+class TestLoaderCallBudgets:
+    def test_call_budgets(self):
+        results = benchmark_loader.run_all()
+        assert_equal(benchmark_loader.check_budgets(results), [])
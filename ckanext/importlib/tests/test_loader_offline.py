@@ -0,0 +1,551 @@
+'''Tests of the loaders against MockCkanServer, which need no CKAN.'''
+import os
+import json
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.importlib.loader import ReplaceByNameLoader, \
+     ReplaceByExtraFieldLoader, ResourceSeriesLoader, LoaderError
+from ckanext.importlib.journal import LoadJournal
+from ckanext.importlib.metrics import MetricsExporter
+from ckanext.importlib.tests.mock_ckanclient import MockCkanServer
+
+class DescriptionIdResourceSeriesLoader(ResourceSeriesLoader):
+    '''Identifies resources by their description.'''
+    def _get_resource_id(self, res):
+        return res['description']
+
+def series_pkg_dict(res_num, department='air'):
+    return {'name': u'pollution',
+            'title': u'Pollution',
+            'extras': {u'department': department,
+                       u'country': u'UK'},
+            'resources': [{'url': u'pollution.com/%i' % res_num,
+                           'description': u'ons/id/%i' % res_num}]}
+
+class TestMockLoader:
+    def setup(self):
+        self.server = MockCkanServer()
+        self.loader = ReplaceByNameLoader(self.server.new_client())
+
+    def test_0_simple_load(self):
+        res_pkg_dict = self.loader.load_package({'name': u'pkgname',
+                                                 'title': u'Boris'})
+        pkg = self.server.get_package('pkgname')
+        assert_equal(pkg['title'], 'Boris')
+        assert_equal(res_pkg_dict['id'], pkg['id'])
+
+    def test_1_load_several_with_errors(self):
+        pkg_dicts = [{'name': u'pkgnameA', # not allowed uppercase name
+                      'title': u'BorisA'},
+                     {'name': u'pkgname_b',
+                      'title': u'BorisB'}]
+        res = self.loader.load_packages(pkg_dicts)
+        assert_equal((res['num_loaded'], res['num_errors']), (1, 1))
+        assert_equal(res['pkg_names'], ['pkgname_b'])
+
+    def test_2_reload(self):
+        self.loader.load_package({'name': u'pkgname2', 'title': u'Boris'})
+        self.server.reset_calls()
+        self.loader.load_package({'name': u'pkgname2', 'title': u'Boris'})
+        assert_equal(self.server.calls.get('package_entity_put'), None)
+        self.loader.load_package({'name': u'pkgname2',
+                                  'title': u'Boris Becker'})
+        assert_equal(self.server.get_package('pkgname2')['title'],
+                     'Boris Becker')
+        assert_equal(len(self.server.packages), 1)
+
+    def test_3_authorization_error_is_fatal(self):
+        self.server.inject_failure('package_register_post', status=403)
+        res = self.loader.load_packages([{'name': u'pkg_a', 'title': u'A'},
+                                         {'name': u'pkg_b', 'title': u'B'}])
+        assert_equal(res['num_errors'], 'fatal')
+        assert_equal(self.server.packages, {})
+
+    def test_4_concurrent_load(self):
+        pkg_dicts = [{'name': u'pkg%i' % i, 'title': u'Pkg %i' % i}
+                     for i in range(20)]
+        res = self.loader.load_packages(
+            pkg_dicts, workers=4, ckanclient_factory=self.server.new_client)
+        assert_equal(res['num_loaded'], 20)
+        assert_equal(res['pkg_names'], [pkg_dict['name']
+                                        for pkg_dict in pkg_dicts])
+
+    def test_4_concurrent_load_of_same_package(self):
+        # latency, so that without serialising, both would look for the
+        # package before either creates it
+        self.server.latency = 0.01
+        pkg_dicts = [{'name': u'pkg', 'title': u'Pkg %i' % i}
+                     for i in range(4)]
+        res = self.loader.load_packages(
+            pkg_dicts, workers=4, ckanclient_factory=self.server.new_client)
+        assert_equal(res['pkg_names'], ['pkg'] * 4)
+        assert_equal(len(self.server.packages), 1)
+
+    def test_5_plan_and_execute(self):
+        self.server.add_package({'name': u'existing', 'title': u'Old'})
+        plan = self.loader.plan([{'name': u'existing', 'title': u'New'},
+                                 {'name': u'new', 'title': u'New'},
+                                 {'name': u'new', 'title': u'Newer'}])
+        assert_equal([operation['action'] for operation in plan],
+                     ['update', 'create', 'combined'])
+        assert_equal(self.server.calls.get('package_entity_put'), None)
+        res = self.loader.execute(plan)
+        assert_equal(res['pkg_names'], ['existing', 'new', 'new'])
+        assert_equal(self.server.get_package('new')['title'], 'Newer')
+        assert_equal(self.server.calls['package_register_post'], 1)
+
+    def test_5_plan_then_load(self):
+        pkg_dicts = [{'name': u'newpkg', 'title': u'New'}]
+        for i in range(2):
+            plan = self.loader.plan(pkg_dicts)
+            assert_equal(plan[0]['name'], 'newpkg')
+        res = self.loader.load_packages(pkg_dicts)
+        assert_equal(res['pkg_names'], ['newpkg'])
+
+    def test_5_failed_create_releases_name(self):
+        self.server.inject_failure('package_register_post', status=500)
+        pkg_dict = {'name': u'newpkg', 'title': u'New'}
+        res = self.loader.load_packages([pkg_dict])
+        assert_equal(res['num_errors'], 1)
+        res = self.loader.load_packages([pkg_dict])
+        assert_equal(res['pkg_names'], ['newpkg'])
+
+    def test_6_resume_with_journal(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            journal_path = os.path.join(tmp_dir, 'load.journal')
+            pkg_dicts = [{'name': u'pkg%i' % i, 'title': u'Pkg %i' % i}
+                         for i in range(4)]
+            journal = LoadJournal(journal_path)
+            self.loader.load_packages(pkg_dicts[:2], journal=journal)
+            journal.close()
+            self.server.reset_calls()
+
+            journal = LoadJournal(journal_path)
+            res = self.loader.load_packages(pkg_dicts, journal=journal)
+            journal.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+        assert_equal(res['num_loaded'], 4)
+        assert_equal(self.server.calls['package_register_post'], 2)
+        assert_equal(self.server.calls['package_entity_get'], 4)
+
+    def test_7_metrics(self):
+        self.loader.load_package({'name': u'pkg_a', 'title': u'A'})
+        self.loader.load_package({'name': u'pkg_a', 'title': u'B'})
+        summary = self.loader.metrics.summary()
+        assert_equal(summary['find']['count'], 2)
+        # (the second time it is cached)
+        assert_equal(summary['find']['api_calls'], {'package_entity_get': 1})
+        assert_equal(summary['ensure_name']['api_calls'],
+                     {'package_entity_get': 1})
+        assert_equal(summary['write']['count'], 2)
+        assert_equal(summary['write']['api_calls'],
+                     {'package_register_post': 1, 'package_entity_put': 1})
+        assert summary['write']['p95'] >= summary['write']['p50']
+        assert_equal(self.loader.metrics.cache_lookups,
+                     {'hit': 1, 'miss': 2})
+        report = self.loader.metrics.report()
+        assert 'compare' in report
+        assert 'Package cache: 1 hits, 2 misses' in report, report
+
+    def test_7_cache_lookups_are_not_stats(self):
+        class RecordingStats(object):
+            def __init__(self):
+                self.messages = []
+            def add(self, message, item):
+                self.messages.append(message)
+        stats = RecordingStats()
+        self.loader = ReplaceByNameLoader(self.server.new_client(),
+                                          stats=stats)
+        self.loader.load_package({'name': u'pkg_a', 'title': u'A'})
+        self.loader.load_package({'name': u'pkg_a', 'title': u'B'})
+        assert_equal(stats.messages, ['Created package', 'Updated package'])
+
+    def test_8_export_metrics(self):
+        self.loader.load_packages([{'name': u'pkg_a', 'title': u'A'},
+                                   {'name': u'pkgB', 'title': u'B'}])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            json_path = os.path.join(tmp_dir, 'metrics.json')
+            prometheus_path = os.path.join(tmp_dir, 'metrics.prom')
+            with MetricsExporter(self.loader.metrics, json_path=json_path,
+                                 prometheus_path=prometheus_path):
+                pass
+            metrics = json.load(open(json_path))
+            prometheus_text = open(prometheus_path).read()
+        finally:
+            shutil.rmtree(tmp_dir)
+        assert_equal(metrics['outcomes'], {'created': 1})
+        assert_equal(metrics['errors'], {'LoaderError': 1})
+        assert 'ckan_loader_packages_total{outcome="created"} 1\n' in \
+               prometheus_text, prometheus_text
+        assert 'ckan_loader_phase_duration_seconds_count{phase="write"} 2\n' \
+               in prometheus_text, prometheus_text
+
+    def test_9_add_to_group(self):
+        self.server.add_group('group1', ['existing'])
+        self.loader.add_pkgs_to_group(['pkg_a', 'existing', 'pkg_b'],
+                                      'group1')
+        assert_equal(self.server.groups['group1']['packages'],
+                     ['existing', 'pkg_a', 'pkg_b'])
+        assert_equal(self.server.calls['member_create'], 2)
+
+    def test_10_add_to_missing_group(self):
+        try:
+            self.loader.add_pkg_to_group('pkg_a', 'missing')
+        except LoaderError, e:
+            assert 'does not exist' in str(e), e
+        else:
+            assert 0, 'Should have raised'
+
+    def test_11_deferred_group_writes(self):
+        self.server.add_group('group1', ['existing'])
+        self.server.add_group('group2')
+        self.loader.defer_group_writes = True
+        pkg_dicts = [{'name': u'pkg_%s' % letter, 'title': letter}
+                     for letter in 'abc']
+        for pkg_dict in pkg_dicts:
+            self.loader.add_pkgs_to_group([pkg_dict['name'], 'existing'],
+                                          'group1')
+        self.loader.add_pkg_to_group('pkg_a', 'group2')
+        assert_equal(self.server.calls, {})
+        self.loader.load_packages(pkg_dicts)
+        assert_equal(self.server.groups['group1']['packages'],
+                     ['existing', 'pkg_a', 'pkg_b', 'pkg_c'])
+        assert_equal(self.server.groups['group2']['packages'], ['pkg_a'])
+        # each group is got once
+        assert_equal(self.server.calls['group_entity_get'], 2)
+        assert_equal(self.server.calls['member_create'], 4)
+        assert_equal(self.loader._pending_group_memberships, {})
+
+    def test_12_deferred_group_write_failures(self):
+        self.server.add_group('group1')
+        self.server.add_group('group2')
+        self.server.inject_failure('member_create', status=404)
+        self.loader.defer_group_writes = True
+        self.loader.add_pkgs_to_group(['pkg_a', 'pkg_b'], 'missing')
+        self.loader.add_pkgs_to_group(['pkg_a', 'pkg_b'], 'group1')
+        self.loader.add_pkgs_to_group(['pkg_a'], 'group2')
+        try:
+            self.loader.flush_group_writes()
+        except LoaderError, e:
+            assert 'missing' in str(e), e
+        else:
+            assert 0, 'Should have raised'
+        # the other groups are still written, as whole groups once
+        # adding members individually failed
+        assert_equal(self.server.groups['group1']['packages'],
+                     ['pkg_a', 'pkg_b'])
+        assert_equal(self.server.groups['group2']['packages'], ['pkg_a'])
+        assert_equal(self.server.calls['member_create'], 1)
+        assert_equal(self.server.calls['group_entity_put'], 2)
+
+
+
+class TestMockLoaderMinimalUpdates:
+    def setup(self):
+        self.server = MockCkanServer()
+        self.loader = ReplaceByNameLoader(self.server.new_client(),
+                                          minimal_updates=True)
+        self.pkg_dict = {'name': u'pkg', 'title': u'A',
+                         'extras': {u'ref': u'r1'},
+                         'resources': [{'url': u'a.com/1',
+                                        'description': u'One'}]}
+        self.res_id = self.server.add_package(
+            self.pkg_dict)['resources'][0]['id']
+        self.server.reset_calls()
+
+    def test_0_unchanged(self):
+        self.loader.load_package(self.pkg_dict)
+        assert_equal(self.server.calls, {'package_entity_get': 1})
+
+    def test_1_changed_field(self):
+        pkg = self.loader.load_package(dict(self.pkg_dict, title=u'B'))
+        assert_equal(pkg['title'], 'B')
+        assert_equal(self.server.calls, {'package_entity_get': 1,
+                                         'package_entity_put': 1})
+        pkg = self.server.get_package('pkg')
+        assert_equal(pkg['title'], 'B')
+        assert_equal(pkg['extras'], {'ref': 'r1'})
+        # the resources were not sent, so were not recreated
+        assert_equal([res['id'] for res in pkg['resources']], [self.res_id])
+
+    def test_2_changed_resource(self):
+        pkg_dict = dict(self.pkg_dict,
+                        resources=[{'url': u'a.com/1', 'description': u'1'},
+                                   {'url': u'a.com/2', 'description': u'2'}])
+        pkg = self.loader.load_package(pkg_dict)
+        assert_equal(self.server.calls, {'package_entity_get': 2,
+                                         'resource_update': 1,
+                                         'resource_create': 1})
+        assert_equal(pkg, self.server.get_package('pkg'))
+        assert_equal([(res['url'], res['description'])
+                      for res in pkg['resources']],
+                     [('a.com/1', '1'), ('a.com/2', '2')])
+        assert_equal(pkg['resources'][0]['id'], self.res_id)
+        assert_equal(pkg['title'], 'A')
+
+    def test_3_failure_falls_back_to_writing_all(self):
+        self.server.inject_failure('resource_update')
+        pkg_dict = dict(self.pkg_dict,
+                        resources=[{'url': u'a.com/1', 'description': u'1'}])
+        pkg = self.loader.load_package(pkg_dict)
+        assert_equal(self.server.calls, {'package_entity_get': 1,
+                                         'resource_update': 1,
+                                         'package_entity_put': 1})
+        assert_equal([res['description'] for res in pkg['resources']],
+                     ['1'])
+        assert_equal(self.server.get_package('pkg')['resources'][0]
+                     ['description'], '1')
+
+
+class TestMockLoaderUsingUniqueFields:
+    def setup(self):
+        self.server = MockCkanServer()
+        self.loader = ReplaceByExtraFieldLoader(self.server.new_client(),
+                                                'ref')
+
+    def test_0_reload(self):
+        self.loader.load_package({'name': u'pkg', 'title': u'A',
+                                  'extras': {u'ref': u'ref1'}})
+        # different ref, so a different package, with the name changed
+        pkg = self.loader.load_package({'name': u'pkg', 'title': u'B',
+                                        'extras': {u'ref': u'ref2'}})
+        assert_equal(pkg['name'], 'pkg_')
+        # same ref as the first
+        pkg = self.loader.load_package({'name': u'pkg', 'title': u'C',
+                                        'extras': {u'ref': u'ref1'}})
+        assert_equal(pkg['name'], 'pkg')
+        assert_equal(self.server.get_package('pkg')['title'], 'C')
+        assert_equal(len(self.server.packages), 2)
+
+    def test_1_index(self):
+        for i in range(25):
+            self.server.add_package({'name': u'pkg%i' % i, 'title': u'A',
+                                     'extras': {u'ref': u'ref%i' % i}})
+        self.loader.build_index(page_size=10)
+        assert_equal(self.server.calls['package_search'], 3)
+        self.server.reset_calls()
+        res = self.loader.load_packages(
+            [{'name': u'pkg%i' % i, 'title': u'A',
+              'extras': {u'ref': u'ref%i' % i}} for i in range(25)])
+        assert_equal(res['num_loaded'], 25)
+        # found without searching (but each got, to compare it)
+        assert_equal(self.server.calls, {'package_entity_get': 25})
+
+    def test_2_reload_with_index_and_fingerprint(self):
+        self.loader = ReplaceByExtraFieldLoader(
+            self.server.new_client(), 'ref',
+            fingerprint_extra_key='import_fingerprint',
+            cache_size=0) # so only the index is relied on
+        pkg_dict = {'name': u'pkg', 'title': u'A', 'extras': {u'ref': u'r1'}}
+        self.loader.load_package(pkg_dict)
+        self.loader.build_index()
+        self.server.reset_calls()
+        for i in range(2):
+            pkg = self.loader.load_package(pkg_dict)
+            assert_equal(pkg, self.server.get_package('pkg'))
+        # unchanged, going by the index, so only got to return it
+        assert_equal(self.server.calls, {'package_entity_get': 2})
+        assert_equal(self.loader._index_by_extra, {u'r1': [u'pkg']})
+        assert self.loader._index['pkg']['fingerprint']
+
+    def test_2_search_result_older_than_cached_package(self):
+        self.loader.load_package({'name': u'pkg', 'title': u'A',
+                                  'extras': {u'ref': u'ref1'}})
+        # as if the search index is not yet updated with the next write
+        search_result = self.server.get_package('pkg')
+        self.loader.load_package({'name': u'pkg', 'title': u'B',
+                                  'extras': {u'ref': u'ref1'}})
+        pkg = self.loader._search_result_to_package(search_result)
+        assert_equal(pkg['title'], 'B')
+        self.server.reset_calls()
+        assert_equal(self.loader._get_package('pkg')['title'], 'B')
+        assert_equal(self.server.calls, {})
+
+    def test_3_name_clash(self):
+        for name in (u'pkg', u'pkg_', u'pkg__'):
+            self.server.add_package({'name': name, 'title': u'Other'})
+        # packages that share the prefix, but are not alternative names
+        for i in range(100):
+            self.server.add_package({'name': u'pkg_%i' % i,
+                                     'title': u'Other'})
+        self.server.reset_calls()
+        pkg = self.loader.load_package({'name': u'pkg', 'title': u'New',
+                                        'extras': {u'ref': u'ref1'}})
+        assert_equal(pkg['name'], 'pkg___')
+        assert_equal(self.server.get_package('pkg___')['title'], 'New')
+        # one search for the ref and one for the alternative names
+        assert_equal(self.server.calls['package_search'], 2)
+
+
+class TestMockLoaderFingerprints:
+    def setup(self):
+        self.server = MockCkanServer()
+        self.pkg_dicts = [{'name': u'pkg%i' % i, 'title': u'A',
+                           'extras': {u'ref': u'ref%i' % i}}
+                          for i in range(5)]
+        self.new_loader().load_packages(self.pkg_dicts)
+        # as in a later run
+        self.loader = self.new_loader()
+        self.server.reset_calls()
+
+    def new_loader(self):
+        return ReplaceByExtraFieldLoader(
+            self.server.new_client(), 'ref',
+            fingerprint_extra_key='import_fingerprint')
+
+    def test_0_fingerprint_is_stored(self):
+        pkg = self.server.get_package('pkg0')
+        assert_equal(pkg['extras']['import_fingerprint'],
+                     self.loader._pkg_fingerprint(self.pkg_dicts[0]))
+        assert_equal(pkg['extras']['ref'], 'ref0')
+
+    def test_1_unchanged(self):
+        res = self.loader.load_packages(self.pkg_dicts)
+        assert_equal(res['num_loaded'], 5)
+        # compared with the search results, without getting the packages
+        assert_equal(self.server.calls, {'package_search': 5})
+        assert_equal(self.loader.metrics.outcomes, {'unchanged': 5})
+
+    def test_2_unchanged_with_index(self):
+        self.loader.build_index()
+        self.server.reset_calls()
+        res = self.loader.load_packages(self.pkg_dicts)
+        assert_equal(res['pkg_names'], [pkg_dict['name']
+                                        for pkg_dict in self.pkg_dicts])
+        # not compared or written, but got to return it
+        assert_equal(self.server.calls, {'package_entity_get': 5})
+        pkg = self.loader.load_package(self.pkg_dicts[0])
+        assert_equal(pkg, self.server.get_package('pkg0'))
+        assert_equal(self.server.calls, {'package_entity_get': 5})
+
+    def test_3_changed(self):
+        self.loader.build_index()
+        self.server.reset_calls()
+        pkg_dict = dict(self.pkg_dicts[0], title=u'B')
+        pkg = self.loader.load_package(pkg_dict)
+        assert_equal(pkg['title'], 'B')
+        assert_equal(self.server.calls, {'package_entity_get': 1,
+                                         'package_entity_put': 1})
+        self.server.reset_calls()
+        # the second time it is unchanged, going by the index (and the
+        # package written is cached)
+        pkg = self.loader.load_package(pkg_dict)
+        assert_equal(pkg, self.server.get_package('pkg0'))
+        assert_equal(self.server.calls, {})
+        assert_equal(self.loader.metrics.outcomes,
+                     {'updated': 1, 'unchanged': 1})
+        fingerprint = self.server.get_package('pkg0')['extras'][
+            'import_fingerprint']
+        assert_equal(fingerprint, self.loader._pkg_fingerprint(pkg_dict))
+        assert fingerprint != self.loader._pkg_fingerprint(
+            self.pkg_dicts[0])
+
+
+class TestMockLoaderInsertingResources:
+    def setup(self):
+        self.server = MockCkanServer()
+        self.loader = DescriptionIdResourceSeriesLoader(
+            self.server.new_client(), ['title', 'department'],
+            field_keys_to_expect_invariant=['country'],
+            synonyms={'department': [('air', 'sky')]})
+
+    def test_0_merge_resources(self):
+        for res_num in (1, 2, 1):
+            self.loader.load_package(series_pkg_dict(res_num))
+        pkg = self.server.get_package('pollution')
+        assert_equal([res['description'] for res in pkg['resources']],
+                     ['ons/id/1', 'ons/id/2'])
+        assert_equal(len(self.server.packages), 1)
+
+    def test_1_synonym(self):
+        self.loader.load_package(series_pkg_dict(1, department='air'))
+        self.loader.load_package(series_pkg_dict(2, department='sky'))
+        assert_equal(len(self.server.packages), 1)
+        pkg = self.server.get_package('pollution')
+        assert_equal(len(pkg['resources']), 2)
+
+    def test_2_synonym_without_solr_queries(self):
+        self.server.supports_solr_queries = False
+        self.loader.load_package(series_pkg_dict(1, department='air'))
+        self.loader.load_package(series_pkg_dict(2, department='sky'))
+        assert_equal(len(self.server.packages), 1)
+
+    def test_3_coalesce(self):
+        self.loader.coalesce = True
+        self.loader.load_package(series_pkg_dict(1))
+        self.server.reset_calls()
+        res = self.loader.load_packages(
+            [series_pkg_dict(2), series_pkg_dict(3, department='sky'),
+             series_pkg_dict(1), series_pkg_dict(4, department='water')])
+        assert_equal(res['num_loaded'], 4)
+        assert_equal(res['pkg_names'], ['pollution', 'pollution',
+                                        'pollution', 'pollution_'])
+        pkg = self.server.get_package('pollution')
+        assert_equal([res['description'] for res in pkg['resources']],
+                     ['ons/id/1', 'ons/id/2', 'ons/id/3'])
+        # one write for each package
+        assert_equal(self.server.calls['package_entity_put'], 1)
+        assert_equal(self.server.calls['package_register_post'], 1)
+        assert_equal(self.loader.metrics.outcomes['combined'], 2)
+
+    def test_4_combined_search_of_new_packages(self):
+        for res_num in range(3):
+            self.loader.load_package(
+                dict(series_pkg_dict(res_num), title=u'Series %i' % res_num))
+        # finding nothing does not prove the combined search works, so
+        # each is checked with a search for each synonym
+        assert_equal(self.server.calls['package_search'], 3 * (1 + 2))
+        assert_equal(self.loader._combined_search_works, None)
+        # until it finds a package that those searches confirm
+        self.loader.load_package(
+            dict(series_pkg_dict(3), title=u'Series 0'))
+        assert_equal(self.loader._combined_search_works, True)
+        self.server.reset_calls()
+        self.loader.load_package(
+            dict(series_pkg_dict(4, department='sky'), title=u'Series 0'))
+        assert_equal(self.server.calls['package_search'], 1)
+        assert_equal(len(self.server.packages), 3)
+
+    def test_5_combined_search_failure_is_not_permanent(self):
+        self.loader.load_package(series_pkg_dict(1))
+        self.server.inject_failure('package_search', status=500)
+        self.loader.load_package(series_pkg_dict(2, department='sky'))
+        assert self.loader._combined_search_works is not False
+        self.loader.load_package(series_pkg_dict(3))
+        assert_equal(self.loader._combined_search_works, True)
+        self.server.reset_calls()
+        self.loader.load_package(series_pkg_dict(4))
+        assert_equal(self.server.calls['package_search'], 1)
+        pkg = self.server.get_package('pollution')
+        assert_equal(len(pkg['resources']), 4)
+
+    def test_6_non_string_identifying_value(self):
+        self.loader = DescriptionIdResourceSeriesLoader(
+            self.server.new_client(), ['title', 'department', 'year'],
+            synonyms={'department': [('air', 'sky')]})
+        for res_num, department in ((1, 'air'), (2, 'sky')):
+            pkg_dict = series_pkg_dict(res_num, department)
+            pkg_dict['extras']['year'] = 2009
+            self.loader.load_package(pkg_dict)
+        assert_equal(len(self.server.packages), 1)
+
+    def test_7_server_with_text_search_only(self):
+        self.server.text_search_only = True
+        self.server.add_package({'name': u'pollution-old',
+                                 'title': u'Pollution',
+                                 'extras': {u'department': u'sky'}})
+        # a new package, which no search finds
+        self.loader.load_package(
+            dict(series_pkg_dict(1), title=u'Series'))
+        # the combined search finds nothing, again, but the package is
+        # there under the synonym
+        pkg = self.loader.load_package(series_pkg_dict(2))
+        assert_equal(pkg['name'], 'pollution-old')
+        assert_equal(len(self.server.packages), 2)
+        assert_equal(self.loader._combined_search_works, False)
@@ -0,0 +1,101 @@
+import time
+import socket
+
+from nose.tools import assert_equal
+from ckanclient import CkanApiError
+
+from ckanext.importlib.scheduler import RequestScheduler, CkanApiActionError
+
+class StubCkanClient(object):
+    '''Responds to package_entity_get and action with the given statuses
+    in turn (200 meaning success, and an exception instance meaning raise
+    it).'''
+    def __init__(self, statuses=None):
+        self.statuses = list(statuses or [])
+        self.last_status = None
+        self.num_calls = 0
+
+    def _respond(self, error_class):
+        self.num_calls += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        if isinstance(status, Exception):
+            self.last_status = None
+            raise status
+        self.last_status = status
+        if status != 200:
+            raise error_class('Status %s' % status)
+        return {'status': status}
+
+    def package_entity_get(self, name):
+        return self._respond(CkanApiError)
+
+    def action(self, action_name, **kwargs):
+        # (ckanclient's Action API errors are not CkanApiErrors)
+        return self._respond(CkanApiActionError)
+
+
+class TestRequestScheduler:
+    def test_0_token_bucket(self):
+        scheduler = RequestScheduler(rate=20, burst=1)
+        client = scheduler.wrap(StubCkanClient())
+        start = time.time()
+        for i in range(5):
+            client.package_entity_get('pkg')
+        # the first is immediate, then one every 1/20 s
+        assert time.time() - start >= 0.19, time.time() - start
+        assert_equal(scheduler.num_requests, 5)
+
+    def test_1_aimd(self):
+        scheduler = RequestScheduler(max_in_flight=8, initial_in_flight=4,
+                                     max_retries=0)
+        client = scheduler.wrap(StubCkanClient([503]))
+        try:
+            client.package_entity_get('pkg')
+        except CkanApiError:
+            pass
+        else:
+            assert 0, 'Should have raised'
+        assert_equal(scheduler.in_flight_limit, 2.0)
+        assert_equal(scheduler.num_overloads, 1)
+        # grows by about 1 for each limit's worth of successes
+        for i in range(2):
+            client.package_entity_get('pkg')
+        assert abs(scheduler.in_flight_limit - 2.9) < 1e-9, scheduler.in_flight_limit
+        for i in range(100):
+            client.package_entity_get('pkg')
+        assert_equal(scheduler.in_flight_limit, 8)
+
+    def test_2_retry_idempotent(self):
+        scheduler = RequestScheduler(backoff=0.001)
+        stub = StubCkanClient([500, 502])
+        assert_equal(scheduler.wrap(stub).package_entity_get('pkg'),
+                     {'status': 200})
+        assert_equal(stub.num_calls, 3)
+        assert_equal(scheduler.num_retries, 2)
+
+    def test_3_release_on_exception(self):
+        scheduler = RequestScheduler(max_in_flight=1, backoff=0.001,
+                                     max_retries=0)
+        stub = StubCkanClient([409, 409, socket.error('reset'),
+                               socket.error('reset')])
+        client = scheduler.wrap(stub)
+        for i in range(2):
+            try:
+                client.action('resource_update', id='res')
+            except CkanApiActionError:
+                pass
+            else:
+                assert 0, 'Should have raised'
+        for i in range(2):
+            try:
+                client.package_entity_get('pkg')
+            except socket.error:
+                pass
+            else:
+                assert 0, 'Should have raised'
+        # would block if a slot had leaked
+        assert_equal(scheduler.wrap(stub).package_entity_get('pkg'),
+                     {'status': 200})
+        assert_equal(scheduler._in_flight, 0)
+        # none of these were overloads
+        assert_equal(scheduler.num_overloads, 0)
@@ -1,4 +1,9 @@
 import os
+import gzip
+import datetime
+import shutil
+import tempfile
+import StringIO
 
 from pylons import config
 
@@ -9,10 +14,13 @@ EXAMPLES_DIR = os.path.join(TEST_DIR, 'samples')
 EXAMPLE_FILEBASE = 'test_importer'
 EXAMPLE_TESTFILE_SUFFIX = '_example'
 EXAMPLE_BIS_TESTFILE_SUFFIX = '_bis_example'
+EXAMPLE_TYPES_TESTFILE_SUFFIX = '_types_example'
 XL_EXTENSION = '.xls'
+XLSX_EXTENSION = '.xlsx'
 CSV_EXTENSION = '.csv'
-EXTENSIONS = [CSV_EXTENSION, XL_EXTENSION]
+EXTENSIONS = [CSV_EXTENSION, XL_EXTENSION, XLSX_EXTENSION]
 SPREADSHEET_DATA_MAP = {XL_EXTENSION:spreadsheet_importer.XlData,
+                        XLSX_EXTENSION:spreadsheet_importer.XlsxData,
                         CSV_EXTENSION:spreadsheet_importer.CsvData}
 
 class ExampleFiles(object):
@@ -59,6 +67,79 @@ class TestSpreadsheetData:
             self.assert_example_data(data)
             assert logger.log == [], logger.log
 
+    def test_2_csv_read_lazily(self):
+        lines = ['name,title'] + ['pkg%i,Package %i' % (i, i) for i in range(250)]
+        data = spreadsheet_importer.CsvData(BasicLogger(), buf='\n'.join(lines))
+        assert len(data._head) == data.look_ahead, len(data._head)
+        assert data.get_row(200) == [u'pkg199', u'Package 199'], data.get_row(200)
+        assert list(data.iter_rows(250)) == [[u'pkg249', u'Package 249']]
+        decoded_rows = []
+        def decode(row, columns=None):
+            decoded_rows.append(row)
+            return spreadsheet_importer.CsvData._decode(data, row, columns)
+        data._decode = decode
+        rows = list(data.iter_rows(98, [1]))
+        assert rows[:3] == [[u'Package 97'], [u'Package 98'], [u'Package 99']], rows[:3]
+        assert len(rows) == 153, len(rows)
+        # rows in the head are not decoded again
+        assert len(decoded_rows) == 151, len(decoded_rows)
+        del data._decode
+        data_records = spreadsheet_importer.SpreadsheetDataRecords(data, 'title')
+        records = [record for record in data_records.records]
+        assert len(records) == 250, len(records)
+        assert records[-1].items() == [(u'name', u'pkg249'), (u'title', u'Package 249')], records[-1].items()
+        # rows are only counted when asked for
+        assert data._num_rows is None
+        assert data.get_num_rows() == 251, data.get_num_rows()
+
+    def test_2_csv_get_row_cache(self):
+        lines = ['name,title'] + ['pkg%i,Package %i' % (i, i) for i in range(250)]
+        data = spreadsheet_importer.CsvData(BasicLogger(), buf='\n'.join(lines))
+        data.row_cache_size = 10
+        reads = []
+        read_rows = data._read_rows
+        def counted_read_rows():
+            reads.append(1)
+            return read_rows()
+        data._read_rows = counted_read_rows
+        # reading on from the last row read does not read from the start
+        rows = [data.get_row(row_index) for row_index in range(251)]
+        assert rows[200] == [u'pkg199', u'Package 199'], rows[200]
+        assert len(reads) == 1, len(reads)
+        # recent rows are cached
+        assert data.get_row(245) == [u'pkg244', u'Package 244']
+        assert data.get_row(245, [1]) == [u'Package 244']
+        assert len(reads) == 2, len(reads)
+        assert data.get_row(245, [1]) == [u'Package 244']
+        assert len(reads) == 2, len(reads)
+        # (but not too many)
+        assert data.get_row(150) == [u'pkg149', u'Package 149']
+        assert len(reads) == 3, len(reads)
+        assert len(data._row_cache) == 10, len(data._row_cache)
+        try:
+            data.get_row(251)
+        except IndexError:
+            pass
+        else:
+            assert 0, 'Should have raised'
+
+    def test_3_xlsx_cell_types(self):
+        logger = BasicLogger()
+        filepath = examples.get_spreadsheet_filepath(EXAMPLE_TYPES_TESTFILE_SUFFIX, XLSX_EXTENSION)
+        data = spreadsheet_importer.XlsxData(logger, filepath=filepath)
+        assert logger.log == ["Warning: Just importing from sheet u'Types'"], logger.log
+        rows = data.get_all_rows()
+        assert rows[1] == [u'a', 3, 2.5, datetime.date(2009, 7, 6), datetime.date(2009, 7, 7), True], rows[1]
+        # missing rows and cells are None
+        assert rows[2] == [None] * 6, rows[2]
+        assert rows[3] == [u'b', None, u'2', None, None, None], rows[3]
+        assert data.get_row(3, [2, 0]) == [u'2', u'b'], data.get_row(3, [2, 0])
+        data_list = data.get_data_by_sheet()
+        assert [sheet_data.get_all_rows() for sheet_data in data_list][1] == [[u'title'], [u'c']]
+        data_records = spreadsheet_importer.MultipleSpreadsheetDataRecords(data_list, ['title'])
+        records = [record for record in data_records.records]
+        assert [record['title'] for record in records] == [u'a', u'b', u'c'], records
+
     def assert_example_data(self, data):
         num_rows = data.get_num_rows()
         assert 3 <= num_rows <= 4, num_rows
@@ -107,6 +188,32 @@ class TestDataRecords:
         assert records[0]['Dataset Ref#'] == 'BIS-000002', records[0]['Dataset Ref#']
         assert records[1]['Dataset Ref#'] == 'BIS-000003', records[1]['Dataset Ref#']
 
+    def test_2_titles_to_import(self):
+        for extension in EXTENSIONS:
+            data = examples.get_data(EXAMPLE_TESTFILE_SUFFIX, extension)
+            assert data.get_row(1, [5, 0]) == [u'encyclopedia reference', u'wikipedia'], data.get_row(1, [5, 0])
+            data_records = spreadsheet_importer.SpreadsheetDataRecords(data, 'title', ['name', 'tags', 'missing'])
+            records = [record for record in data_records.records]
+            assert len(records) == 2, records
+            assert records[0].items() == [
+                (u'name', u'wikipedia'),
+                (u'tags', u'encyclopedia reference'),
+                ], records[0].items()
+
+    def test_3_sheets_share_workbook(self):
+        data = examples.get_data(EXAMPLE_BIS_TESTFILE_SUFFIX, XL_EXTENSION)
+        data_list = data.get_data_by_sheet()
+        assert len(data_list) == 2, data_list
+        for sheet_data in data_list:
+            assert sheet_data._book is data._book
+        # sheets are only loaded when used, and released after reading
+        assert data._book._sheet_list == [None, None], data._book._sheet_list
+        data_records = spreadsheet_importer.MultipleSpreadsheetDataRecords(data_list, ['Dataset Ref#'])
+        records = [record for record in data_records.records]
+        assert len(records) == 11, records
+        assert records[2]['Dataset Ref#'] == 'BIS-000001', records[2]
+        assert data._book._sheet_list == [None, None], data._book._sheet_list
+
 class TestPackageImporter:
     def test_munge(self):
         def test_munge(title, expected_munge):
@@ -128,3 +235,55 @@ class TestPackageImporter:
         assert len(pkg_dicts) == 2, pkg_dicts
         assert pkg_dicts[0].items() == [(u'name', u'wikipedia'), (u'title', u'Wikipedia'), ('resources', [{'url': u'http://static.wikipedia.org/downloads/2008-06/en/wikipedia-en-html.tar.7z', 'alt_url': u'', 'hash': u'', 'description': u'In English', 'format': u'html'}]), (u'tags', u'encyclopedia reference')], pkg_dicts[0].items()
         assert pkg_dicts[1].items() == [(u'name', u'tviv'), (u'title', u'TV IV'), ('resources', [{'url': u'http://tviv.org/Category:Grids', 'alt_url': u'', 'hash': u'', 'description': u'', 'format': u''}]), (u'tags', u'tv encyclopedia')], pkg_dicts[1].items()        
+
+class TestSpreadsheetFormats:
+    def read_example(self, extension):
+        f = open(examples.get_spreadsheet_filepath(EXAMPLE_TESTFILE_SUFFIX, extension), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def gzip(self, buf):
+        out = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb')
+        f.write(buf)
+        f.close()
+        return out.getvalue()
+
+    def test_0_detect(self):
+        for extension, format_name in ((CSV_EXTENSION, 'csv'), (XL_EXTENSION, 'xls'), (XLSX_EXTENSION, 'xlsx')):
+            name, opener, reads_gzip = spreadsheet_importer.detect_spreadsheet_format(self.read_example(extension))
+            assert name == format_name, name
+        name, opener, reads_gzip = spreadsheet_importer.detect_spreadsheet_format('PK\x03\x04\x14\x00\x00\x00\x08\x00[Content_Types].xml')
+        assert name == 'xlsx', name
+        name, opener, reads_gzip = spreadsheet_importer.detect_spreadsheet_format('\x00\x01', filepath='/tmp/data.XLS')
+        assert name == 'xls', name
+
+    def test_1_gzipped(self):
+        for extension in EXTENSIONS:
+            buf = self.gzip(self.read_example(extension))
+            data = spreadsheet_importer.open_spreadsheet_data(BasicLogger(), buf=buf)
+            TestSpreadsheetData().assert_example_data(data)
+
+    def test_2_gzipped_csv_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmp_dir, 'example.csv.gz')
+            f = open(filepath, 'wb')
+            f.write(self.gzip(self.read_example(CSV_EXTENSION)))
+            f.close()
+            data = spreadsheet_importer.open_spreadsheet_data(BasicLogger(), filepath=filepath)
+            assert isinstance(data, spreadsheet_importer.CsvData), data
+            TestSpreadsheetData().assert_example_data(data)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_3_unsupported(self):
+        buf = 'PK\x03\x04\x14\x00\x00\x00\x00\x00mimetypeapplication/vnd.oasis.opendocument.spreadsheet'
+        try:
+            spreadsheet_importer.open_spreadsheet_data(BasicLogger(), buf=buf)
+        except spreadsheet_importer.ImportException, e:
+            assert 'ods' in str(e), e
+        else:
+            assert 0, 'Should have raised'